@@ -1,3 +1,4 @@
+import logging
 from os import environ
 
 import uvicorn
@@ -7,8 +8,13 @@ def main():
 
     IFACE = environ.get("INGEST_SERVER_HOST", "0.0.0.0")  # noqa: S104
     PORT = int(environ.get("INGEST_SERVER_PORT", "5050"))
+    WORKERS = int(environ.get("INGEST_SERVER_WORKERS", "1"))
 
-    uvicorn.run("code_ingest.ingest_server:app", host=IFACE, port=PORT, debug=False)
+    if WORKERS > 1 and environ.get("CODE_INGEST_STORE", "memory") == "memory":
+        logging.warning("Several workers with the memory store can't see each other's runs, "
+                        "set CODE_INGEST_STORE to a shared store.")
+
+    uvicorn.run("code_ingest.ingest_server:app", host=IFACE, port=PORT, debug=False, workers=WORKERS)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Runs inside the sandbox for /run/<interpreter>/batch, so it only uses what the image's python3 ships with.
+# It starts as root and runs setup, the build and every case as the sandbox user, so nothing the submission runs
+# can reach the runner or the results it writes.
+import json
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+from base64 import b64decode, b64encode
+from time import monotonic
+
+CASES_FILE = ".cases.json"
+READ_SIZE = 65536
+SANDBOX_UID = 1000
+SANDBOX_HOME = "/home/ractf"
+
+
+def sandboxed():
+    # Outside a container, such as under the fake Docker backend, the runner isn't root and runs as it is.
+    if os.getuid() != 0:
+        return {}
+    return {
+        "user": SANDBOX_UID,
+        "group": SANDBOX_UID,
+        "extra_groups": [],
+        "env": dict(os.environ, HOME=SANDBOX_HOME, USER="ractf", LOGNAME="ractf"),
+    }
+
+
+def feed(pipe, data) -> None:
+    try:
+        pipe.write(data)
+        pipe.close()
+    except(OSError):
+        ...
+
+
+def run_case(cmd, stdin, time_limit, output_max):
+    start = monotonic()
+    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, start_new_session=True, **sandboxed())
+    threading.Thread(target=feed, args=(proc.stdin, stdin), daemon=True).start()
+
+    # Both pipes are drained as the case runs, anything past output_max is read and dropped.
+    output = {proc.stdout: bytearray(), proc.stderr: bytearray()}
+    truncated = False
+    timed_out = False
+    selector = selectors.DefaultSelector()
+    for pipe in output:
+        selector.register(pipe, selectors.EVENT_READ)
+
+    deadline = start + time_limit
+    while selector.get_map():
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+        for key, _ in selector.select(remaining):
+            data = os.read(key.fd, READ_SIZE)
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            buffer = output[key.fileobj]
+            if len(buffer) + len(data) > output_max:
+                data = data[:max(output_max - len(buffer), 0)]
+                truncated = True
+            buffer += data
+
+    try:
+        exit_code = proc.wait(max(deadline - monotonic(), 0))
+    except(subprocess.TimeoutExpired):
+        timed_out = True
+    elapsed = monotonic() - start
+
+    # The whole process group goes, so nothing a case started in the background outlives it.
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except(OSError):
+        ...
+    if timed_out:
+        exit_code = proc.wait()
+    selector.close()
+    for pipe in output:
+        pipe.close()
+
+    return {
+        "result": b64encode(bytes(output[proc.stdout])).decode(),
+        "stderr": b64encode(bytes(output[proc.stderr])).decode(),
+        # Match Docker, which reports a process killed by a signal as 128 plus the signal number.
+        "status_code": str(exit_code if exit_code >= 0 else 128 - exit_code),
+        "time": f"{elapsed:.4f}",
+        **({"timeout": "0"} if timed_out else {}),
+        **({"truncated": "0"} if truncated else {}),
+    }
+
+
+def main() -> int:
+    with open(CASES_FILE) as cases_file:
+        spec = json.load(cases_file)
+    os.remove(CASES_FILE)
+
+    sys.stdout.flush()
+    subprocess.call(spec["setup"], shell=True, **sandboxed())
+
+    # Compiled code is built once for every case, unless the build cache already supplied the program.
+    if spec["build"] and "prebuilt" not in sys.argv[1:]:
+        status = subprocess.call(spec["build"], shell=True, **sandboxed())
+        if status != 0:
+            return status
+
+    cases = [run_case(spec["run"], b64decode(case["stdin"]), case["time_limit"], spec["output_max"])
+             for case in spec["cases"]]
+
+    # The results go to a file only the runner can write, read back once the container exits. Anything on
+    # stdout came from setup or the build, or from a case printing where it shouldn't.
+    results = os.open(spec["results"], os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    with os.fdopen(results, "w") as results_file:
+        json.dump({"cases": cases}, results_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
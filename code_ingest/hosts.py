@@ -0,0 +1,172 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import random
+import threading
+from time import sleep
+from typing import Any, List, Optional
+
+import docker
+
+HOST_CHECK_INTERVAL = 5
+INSTANCE_LABEL = "code_ingest.instance"
+# The cores a container was pinned to at creation, so every worker can see what the others have claimed.
+CPUSET_LABEL = "code_ingest.cpuset"
+
+
+class NoHostAvailableError(Exception):
+    ...
+
+
+class DockerHost():
+
+    # One Docker daemon we can place runs on. The client is anything shaped like docker.DockerClient.
+
+    def __init__(self, name: str, client: Any, instance_id: str = ""):
+        self.name = name
+        self.client = client
+        self.instance_id = instance_id
+        self.healthy = True
+        # Set once the host has every image, until then a reachable daemon still isn't fit to place runs on.
+        self.images_ready = False
+        self.mem_total = 0
+        # How many running containers are pinned to each of the host's cores.
+        self.cores: List[int] = []
+        # Containers other workers have pinned to each core, as of the last refresh.
+        self.foreign_cores: List[int] = []
+        # Where this worker starts among equally busy cores, so workers don't all pile onto core 0.
+        self.core_offset = random.randrange(1 << 16)  # noqa: S311
+        self.cores_lock = threading.Lock()
+        self.daemon_running = 0
+        # Runs placed since the last refresh, which the daemon's own count doesn't include yet.
+        self.placed = 0
+
+    def refresh(self) -> None:
+        try:
+            info = self.client.info()
+            self.mem_total = info.get("MemTotal", 0)
+            self.daemon_running = info.get("ContainersRunning", 0)
+            self.__resize_cores(info.get("NCPU", 0))
+            self.__count_foreign_cores()
+            self.placed = 0
+            if self.images_ready:
+                if not self.healthy:
+                    logging.info(f"Docker host {self.name} is back up.")
+                self.healthy = True
+
+        except(docker.errors.APIError, OSError):
+            self.mark_down()
+
+    def __resize_cores(self, cpus: int) -> None:
+        with self.cores_lock:
+            if cpus > len(self.cores):
+                self.cores.extend([0] * (cpus - len(self.cores)))
+            elif cpus < len(self.cores):
+                # Runs pinned to cores the host no longer has keep running, they just stop being counted.
+                del self.cores[cpus:]
+
+    def __count_foreign_cores(self) -> None:
+        # Pooled containers are pinned after they start, so only cold starts and builds carry the label.
+        counts = [0] * len(self.cores)
+        for container in self.client.containers.list(sparse=True, filters={"label": CPUSET_LABEL}):
+            labels = container.attrs.get("Labels") or (container.attrs.get("Config") or {}).get("Labels") or {}
+            if labels.get(INSTANCE_LABEL, None) == self.instance_id:
+                continue
+            for core in labels.get(CPUSET_LABEL, "").split(","):
+                if core.isdigit() and int(core) < len(counts):
+                    counts[int(core)] += 1
+        with self.cores_lock:
+            self.foreign_cores = counts
+
+    def __occupancy(self, core: int) -> int:
+        return self.cores[core] + (self.foreign_cores[core] if core < len(self.foreign_cores) else 0)
+
+    def claim_cores(self, count: int) -> Optional[str]:
+        # Takes the least occupied cores across every worker, so runs only start sharing once every core is busy.
+        with self.cores_lock:
+            if not self.cores:
+                return None
+            cores = len(self.cores)
+            chosen = sorted(sorted(range(cores), key=lambda core: (
+                self.__occupancy(core), (core - self.core_offset) % cores
+            ))[:count])
+            for core in chosen:
+                self.cores[core] += 1
+            return ",".join(str(core) for core in chosen)
+
+    def release_cores(self, cpuset: str) -> None:
+        with self.cores_lock:
+            for core in map(int, cpuset.split(",")):
+                if core < len(self.cores) and self.cores[core] > 0:
+                    self.cores[core] -= 1
+
+    def free_cores(self) -> int:
+        with self.cores_lock:
+            return sum(1 for core in range(len(self.cores)) if self.__occupancy(core) == 0)
+
+    def mark_down(self) -> None:
+        if self.healthy:
+            logging.warning(f"Docker host {self.name} is down, no new runs will be placed on it.")
+        self.healthy = False
+
+    def load(self) -> int:
+        return self.daemon_running + self.placed
+
+
+class HostPool():
+
+    # Places each run on a healthy host with an idle core if there is one, then by the most memory to spare and
+    # the fewest running containers.
+
+    def __init__(self, hosts: List[DockerHost], mem_per_run: int):
+        self.hosts = hosts
+        self.mem_per_run = mem_per_run
+        self.lock = threading.Lock()
+        self.watch_thread: Optional[threading.Thread] = None
+
+    def place(self) -> DockerHost:
+        with self.lock:
+            healthy = [host for host in self.hosts if host.healthy]
+            if not healthy:
+                raise NoHostAvailableError
+
+            host = max(healthy, key=lambda host: (
+                host.free_cores() > 0,
+                host.mem_total - host.load() * self.mem_per_run if host.mem_total else 0,
+                -host.load(),
+            ))
+            host.placed += 1
+            return host
+
+    def get(self, name: Optional[str]) -> Optional[DockerHost]:
+        for host in self.hosts:
+            if host.name == name:
+                return host
+        return None
+
+    def healthy(self) -> List[DockerHost]:
+        return [host for host in self.hosts if host.healthy]
+
+    def __watch(self) -> None:
+        while True:
+            for host in self.hosts:
+                host.refresh()
+            sleep(HOST_CHECK_INTERVAL)
+
+    def watch(self) -> None:
+        if self.watch_thread is None:
+            self.watch_thread = threading.Thread(target=self.__watch, daemon=True)
+            self.watch_thread.start()
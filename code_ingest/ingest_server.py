@@ -14,18 +14,27 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from base64 import b64decode, b64encode
+import json
+import math
+from base64 import b64decode
 from binascii import Error
 from json.decoder import JSONDecodeError
 from os import environ
 from secrets import compare_digest, token_hex
-from typing import List, Union
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
 
+from docker.utils import parse_bytes
 from starlette.applications import Starlette
-from starlette.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
 from starlette.routing import BaseRoute, Route
 
-from .pipeline import DockerPipeline
+from .pipeline import BATCH_CMD, SETUP_CMD, DockerPipeline
+from .responses import FastJSONResponse, loads, prerender, prerender_error
+from .scheduler import PRIORITY_CLASSES, QueueFullError
+from .store import open_store
+from .uploads import UPLOAD_TYPES, UploadTooLargeError, sanitize_upload, spool_upload
 
 ext_map = {
     "python": "script.py",
@@ -38,135 +47,421 @@ ext_map = {
     "nasm": "script.asm"
 }
 
+# Compiled interpreters, split into the build step and the command running what it built.
+build_map = {
+    "gcc": (f"gcc {ext_map['gcc']} -o program", "./program"),
+    "cpp": (f"g++ {ext_map['cpp']} -o program", "./program"),
+    "nasm": (f"nasm -f elf64 {ext_map['nasm']} && ld -s -o program script.o", "./program"),
+}
+
+# Uploaded projects, split into an optional build step over every source file and the entry point.
+# Java is left out as the image only has the JRE, which can't compile more than one file.
+project_map = {
+    "python": (None, "python3 main.py"),
+    "gcc": ("gcc *.c -o program", "./program"),
+    "cpp": ("g++ *.cpp -o program", "./program"),
+    "perl": (None, "perl main.pl"),
+    "ruby": (None, "ruby main.rb"),
+    "node": (None, "node main.js"),
+    "nasm": ("for f in *.asm; do nasm -f elf64 $f || exit 1; done && ld -s -o program *.o", "./program"),
+}
+
 cmd_map = {
     "python": f"python3 {ext_map['python']}",
-    "gcc": f"gcc {ext_map['gcc']} -o program && ./program",
-    "cpp": f"g++ {ext_map['cpp']} -o program && ./program",
+    "gcc": " && ".join(build_map["gcc"]),
+    "cpp": " && ".join(build_map["cpp"]),
     "perl": f"perl {ext_map['perl']}",
     "ruby": f"ruby {ext_map['ruby']}",
     "java": f"java {ext_map['java']}",
     "node": f"node {ext_map['node']}",
-    "nasm": (f"nasm -f elf64 {ext_map['nasm']} && "
-             "ld -s -o program script.o && ./program")
+    "nasm": " && ".join(build_map["nasm"]),
+}
+
+
+def _wrap_cmd(exec_cmd) -> str:
+    return f"/bin/sh -c 'cd /home/ractf; {SETUP_CMD}; {exec_cmd}'"
+
+
+# Everything a request needs per interpreter is built here once, rather than on every request.
+# Runs: (file name, wrapped command, (build step, wrapped artifact command) or None).
+run_specs: Dict[str, Tuple[str, str, Optional[Tuple[str, str]]]] = {
+    interpreter: (
+        ext_map[interpreter],
+        _wrap_cmd(exec_cmd),
+        (build_map[interpreter][0], _wrap_cmd(build_map[interpreter][1])) if interpreter in build_map else None,
+    )
+    for interpreter, exec_cmd in cmd_map.items()
+}
+
+# Batches: (file name, command the runner runs each case with, build step or None).
+batch_specs: Dict[str, Tuple[str, str, Optional[str]]] = {
+    interpreter: (
+        ext_map[interpreter],
+        build_map[interpreter][1] if interpreter in build_map else exec_cmd,
+        build_map[interpreter][0] if interpreter in build_map else None,
+    )
+    for interpreter, exec_cmd in cmd_map.items()
+}
+# The batch runner runs setup itself, as the sandbox user, so its command isn't wrapped.
+BATCH_EXEC = f"/bin/sh -c 'cd /home/ractf; exec {BATCH_CMD}'"
+BATCH_PREBUILT = f"/bin/sh -c 'cd /home/ractf; exec {BATCH_CMD} prebuilt'"
+
+project_cmds = {
+    interpreter: _wrap_cmd(f"{build_cmd} && {entry_cmd}" if build_cmd is not None else entry_cmd)
+    for interpreter, (build_cmd, entry_cmd) in project_map.items()
+}
+
+# Constant responses, encoded once.
+INVALID_PARAMS = prerender_error(b"Error: Invalid/missing required parameters or endpoint.")
+QUEUE_FULL = prerender_error(b"Error: Too many submissions queued, please try again later.")
+NOT_READY = prerender_error(b"Error: The server is still starting up, please try again shortly.")
+AUTH_ERROR = prerender_error(b"AuthError: Invalid or missing auth token.")
+UPLOAD_TOO_LARGE = prerender_error(b"Error: The upload is too large.")
+ADMIN_AUTH_ERROR = prerender({'result': "AuthError: Invalid or missing auth token.", 'status': "1"})
+ADMIN_INVALID = prerender({'result': "Error: Invalid/missing required parameters or endpoint.", 'status': "1"})
+HEALTHY = prerender({"status": "0"})
+
+
+# Alpine packages each interpreter needs in its own slim image, interpreters sharing packages share the image.
+image_packages = {
+    "python": "python3",
+    "gcc": "build-base",
+    "cpp": "build-base",
+    "perl": "perl",
+    "ruby": "ruby",
+    "java": "openjdk11-jre-headless",
+    "node": "nodejs",
+    "nasm": "nasm binutils",
 }
 
 # Setup ENV Vars with some defaults.
 IMAGE_NAME = environ.get("CODE_INGEST_IMAGE", "sh3llcod3/code-ingest")
 LOG_MAX = environ.get("CODE_INGEST_MAX_OUTPUT", '1001')
 MEMORY_LIMIT = environ.get("CODE_INGEST_RAM_LIMIT", "24m")
+MAX_UPLOAD = parse_bytes(environ.get("CODE_INGEST_MAX_UPLOAD", "4m"))
+CPUS_PER_RUN = float(environ.get("CODE_INGEST_CPUS_PER_RUN", "1"))
 ADM_TOKEN = environ.get("CODE_INGEST_ADM_TOKEN", token_hex())
 DISPLAY_ADM_TOKENS = bool(int(environ.get("CODE_INGEST_SPLASH_TOKENS", "1")))
 CONTAINER_TIMEOUT_VAL = int(environ.get("CODE_INGEST_TIMEOUT", "45"))
+POOL_MIN = int(environ.get("CODE_INGEST_POOL_MIN", "0"))
+POOL_MAX = int(environ.get("CODE_INGEST_POOL_MAX", "0"))
+DOCKER_CONCURRENCY = int(environ.get("CODE_INGEST_DOCKER_CONCURRENCY", "16"))
+# Running and queued limits, here and for tenants, apply per worker process as each keeps its own queue.
+MAX_RUNNING = int(environ.get("CODE_INGEST_MAX_RUNNING", "0"))
+MAX_QUEUED = int(environ.get("CODE_INGEST_MAX_QUEUED", "100"))
+RESULT_TTL = int(environ.get("CODE_INGEST_RESULT_TTL", "60"))
+KILL_ON_MAX_OUTPUT = bool(int(environ.get("CODE_INGEST_KILL_ON_MAX_OUTPUT", "1")))
+BUILD_CACHE_MAX = int(environ.get("CODE_INGEST_BUILD_CACHE", "0"))
+RESULT_CACHE_MAX = int(environ.get("CODE_INGEST_RESULT_CACHE", "0"))
+RESULT_CACHE_TTL = int(environ.get("CODE_INGEST_RESULT_CACHE_TTL", "300"))
+SNAPSHOTS = bool(int(environ.get("CODE_INGEST_SNAPSHOTS", "0")))
+RESULT_STORE = environ.get("CODE_INGEST_STORE", "memory")
+BATCH_MAX_CASES = int(environ.get("CODE_INGEST_BATCH_MAX_CASES", "32"))
+BATCH_TIME_LIMIT = float(environ.get("CODE_INGEST_BATCH_TIME_LIMIT", "5"))
+STATS_INTERVAL = float(environ.get("CODE_INGEST_STATS_INTERVAL", "1"))
+RECONCILE_INTERVAL = float(environ.get("CODE_INGEST_RECONCILE_INTERVAL", "60"))
+SLIM_IMAGES = bool(int(environ.get("CODE_INGEST_SLIM_IMAGES", "0")))
+TENANT_MAX_RUNNING = int(environ.get("CODE_INGEST_TENANT_MAX_RUNNING", "0"))
+TENANT_MAX_QUEUED = int(environ.get("CODE_INGEST_TENANT_MAX_QUEUED", "0"))
+# Comma separated tenant=weight pairs, tenants not listed get a weight of 1.
+TENANT_WEIGHTS = {
+    tenant.strip(): float(weight)
+    for tenant, _, weight in (pair.partition("=") for pair in environ.get("CODE_INGEST_TENANT_WEIGHTS", "").split(","))
+    if tenant.strip()
+}
+CHECKER_TOKEN = environ.get("CODE_INGEST_CHECKER_TOKEN", ADM_TOKEN)
+DOCKER_HOSTS = [host.strip() for host in environ.get("CODE_INGEST_DOCKER_HOSTS", "").split(",") if host.strip()]
 
 code_pipeline = DockerPipeline(
     image_name=IMAGE_NAME,
-    file_method="Volumes",
+    file_method="Archive",
     auto_remove=False,
     container_lifetime=CONTAINER_TIMEOUT_VAL,
     disable_network=True,
     net="none",
     mem_max=MEMORY_LIMIT,
+    cpus_per_run=CPUS_PER_RUN,
     use_tty=False,
     output_max=int(LOG_MAX),
+    pool_min=POOL_MIN,
+    pool_max=POOL_MAX,
+    pool_interpreters=list(cmd_map),
+    docker_concurrency=DOCKER_CONCURRENCY,
+    max_running=MAX_RUNNING,
+    max_queued=MAX_QUEUED,
+    tenant_max_running=TENANT_MAX_RUNNING,
+    tenant_max_queued=TENANT_MAX_QUEUED,
+    tenant_weights=TENANT_WEIGHTS,
+    result_ttl=RESULT_TTL,
+    kill_on_output_max=KILL_ON_MAX_OUTPUT,
+    build_cache_max=BUILD_CACHE_MAX,
+    result_cache_max=RESULT_CACHE_MAX,
+    result_cache_ttl=RESULT_CACHE_TTL,
+    snapshots=SNAPSHOTS,
+    store=open_store(RESULT_STORE),
+    docker_hosts=DOCKER_HOSTS,
+    stats_interval=STATS_INTERVAL,
+    reconcile_interval=RECONCILE_INTERVAL,
+    interpreter_images={
+        interpreter: (f"{IMAGE_NAME}-{packages.split()[0]}", packages)
+        for interpreter, packages in image_packages.items()
+    } if SLIM_IMAGES else {},
 )
 
 
 async def check_image() -> None:
     await code_pipeline._build_map()
-    await code_pipeline.pull_image(IMAGE_NAME, DISPLAY_ADM_TOKENS, ADM_TOKEN)
+    code_pipeline.start(IMAGE_NAME, DISPLAY_ADM_TOKENS, ADM_TOKEN)
+
 
+def _caller(params) -> Tuple[str, str]:
+    # Checker runs jump every queue, so only callers holding the checker token may ask for them.
+    tenant = str(params.get('tenant', ''))
+    priority = params.get('priority', 'normal')
+    if len(tenant) > 64 or priority not in PRIORITY_CLASSES:
+        raise ValueError
+    if priority == 'checker' and not compare_digest(str(params.get('token', '')), CHECKER_TOKEN):
+        raise PermissionError
+    return tenant, priority
 
-async def run_code(request) -> JSONResponse:
+
+def _setup_name(params) -> str:
+    setup_file = params.get('chall', '0')
+    if not isinstance(setup_file, str):
+        raise TypeError
+    return setup_file
+
+
+def _respond(body: bytes, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    return Response(body, status_code, headers, media_type="application/json")
+
+
+async def run_code(request) -> Response:
+
+    if not code_pipeline.ready():
+        return _respond(NOT_READY, 503, {"Retry-After": "5"})
 
     try:
         interpreter = request.path_params.get('interpreter', False)
-        exec_cmd: Union[str, bool] = cmd_map.get(interpreter, False)
-        ext: str = ext_map.get(interpreter, "")
-        data: Union[str, None, bytes] = b64decode((await request.json()).get('exec', None))
-        setup_file = (await request.json()).get('chall', '0')
+        ext, exec_method, build = run_specs[interpreter]
+        decoding = monotonic()
+        params = loads(await request.body())
+        data = b64decode(params.get('exec', None))
+        setup_file = _setup_name(params)
+        tenant, priority = _caller(params)
+        code_pipeline.decode_seconds.observe(monotonic() - decoding, interpreter=interpreter)
 
-        if not (exec_cmd or ext) or data is None:
+        return FastJSONResponse(
+            await code_pipeline.run_container(
+                data,
+                exec_method,
+                ext,
+                setup_file,
+                interpreter,
+                build,
+                tenant=tenant,
+                priority=priority
+            )
+        )
+
+    except(PermissionError):
+        return _respond(AUTH_ERROR, 403)
+
+    except(QueueFullError):
+        return _respond(QUEUE_FULL, 429, {"Retry-After": "1"})
+
+    except(Error, KeyError, TypeError, ValueError, JSONDecodeError):
+        return _respond(INVALID_PARAMS)
+
+
+async def run_batch(request) -> Response:
+
+    if not code_pipeline.ready():
+        return _respond(NOT_READY, 503, {"Retry-After": "5"})
+
+    try:
+        interpreter = request.path_params.get('interpreter', False)
+        ext, run_cmd, build_cmd = batch_specs[interpreter]
+        decoding = monotonic()
+        params = loads(await request.body())
+        data = b64decode(params.get('exec', None))
+        setup_file = _setup_name(params)
+        default_limit = float(params.get('time_limit', BATCH_TIME_LIMIT))
+        tenant, priority = _caller(params)
+
+        # Each case is a base64 stdin and an optional time limit, capped at the container lifetime.
+        cases = [
+            (b64decode(case.get('stdin', '')),
+             min(float(case.get('time_limit', default_limit)), CONTAINER_TIMEOUT_VAL))
+            for case in params.get('cases', None)
+        ]
+
+        if not 0 < len(cases) <= BATCH_MAX_CASES:
             raise ValueError
+        if any(not math.isfinite(time_limit) or time_limit <= 0 for _, time_limit in cases):
+            raise ValueError
+        code_pipeline.decode_seconds.observe(monotonic() - decoding, interpreter=interpreter)
 
-        return JSONResponse(
-            await code_pipeline.run_container(
+        return FastJSONResponse(
+            await code_pipeline.run_batch(
                 data,
-                (f"/bin/sh -c 'cd /home/ractf; chmod +x setup.sh && sh ./setup.sh;"
-                 f" dd if=/dev/null of=setup.sh &>/dev/null; {exec_cmd}'"),
                 ext,
-                setup_file
+                setup_file,
+                interpreter,
+                run_cmd,
+                build_cmd,
+                cases,
+                BATCH_EXEC,
+                (build_cmd, BATCH_PREBUILT) if build_cmd is not None else None,
+                tenant=tenant,
+                priority=priority
             )
         )
 
-    except(Error, TypeError, ValueError, JSONDecodeError):
-        return JSONResponse(
-            {
-                'result': b64encode(
-                    b"Error: Invalid/missing required parameters or endpoint."
-                ).decode()
-            }
+    except(PermissionError):
+        return _respond(AUTH_ERROR, 403)
+
+    except(QueueFullError):
+        return _respond(QUEUE_FULL, 429, {"Retry-After": "1"})
+
+    except(Error, KeyError, TypeError, ValueError, AttributeError, JSONDecodeError):
+        return _respond(INVALID_PARAMS)
+
+
+async def run_project(request) -> Response:
+
+    if not code_pipeline.ready():
+        return _respond(NOT_READY, 503, {"Retry-After": "5"})
+
+    upload = None
+    try:
+        interpreter = request.path_params.get('interpreter', False)
+        exec_method = project_cmds[interpreter]
+        compressed = UPLOAD_TYPES[request.headers.get('content-type', '').split(';')[0].strip()]
+        setup_file = request.query_params.get('chall', '0')
+        tenant, priority = _caller(request.query_params)
+
+        if int(request.headers.get('content-length', '0')) > MAX_UPLOAD:
+            raise UploadTooLargeError
+
+        # The body is spooled as it arrives, never decoded or held in memory whole.
+        decoding = monotonic()
+        upload = await spool_upload(request.stream(), compressed, MAX_UPLOAD)
+        upload = await run_in_threadpool(sanitize_upload, upload)
+        code_pipeline.decode_seconds.observe(monotonic() - decoding, interpreter=interpreter)
+
+        response = await code_pipeline.run_project(
+            upload,
+            exec_method,
+            setup_file,
+            interpreter,
+            tenant,
+            priority
         )
+        upload = None
+        return FastJSONResponse(response)
+
+    except(PermissionError):
+        return _respond(AUTH_ERROR, 403)
+
+    except(QueueFullError):
+        return _respond(QUEUE_FULL, 429, {"Retry-After": "1"})
 
+    except(UploadTooLargeError):
+        return _respond(UPLOAD_TOO_LARGE, 413)
 
-async def check_result(request) -> JSONResponse:
+    except(KeyError, TypeError, ValueError):
+        return _respond(INVALID_PARAMS)
+
+    finally:
+        if upload is not None:
+            upload.close()
+
+
+async def check_result(request) -> Response:
 
     try:
 
-        return JSONResponse(
-            await code_pipeline.poll_result(request.path_params.get('token', None))
+        return FastJSONResponse(
+            await code_pipeline.poll_result(
+                request.path_params.get('token', None),
+                int(request.query_params.get('wait', '0')),
+                int(request.query_params['since']) if 'since' in request.query_params else None
+            )
         )
 
     except(Error, TypeError, ValueError, JSONDecodeError):
-        return JSONResponse(
-            {
-                'result': b64encode(
-                    b"Error: Invalid/missing required parameters or endpoint."
-                ).decode()
-            }
-        )
+        return _respond(INVALID_PARAMS)
+
+
+async def stream_result(request) -> StreamingResponse:
+
+    async def events():
+        async for event, data in code_pipeline.stream_result(request.path_params.get('token', None)):
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+async def health(request) -> Response:
+    return _respond(HEALTHY)
+
+
+async def readiness(request) -> Response:
+    status = code_pipeline.readiness()
+    return FastJSONResponse(status, status_code=200 if status["status"] == "0" else 503)
+
+
+async def metrics(request) -> PlainTextResponse:
+    return PlainTextResponse(code_pipeline.metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+admin_actions = {
+    "prune": code_pipeline._prune_container,
+    "setupfiles": code_pipeline._get_setup_files,
+    "containercount": code_pipeline._get_container_count,
+    "kill": code_pipeline._kill_container,
+    "reset": code_pipeline._reset_all,
+    "flushcache": code_pipeline._flush_caches,
+    "stats": code_pipeline._get_usage_stats,
+    "tenants": code_pipeline._get_tenant_stats
+}
 
 
-async def admin_functions(request) -> JSONResponse:
+async def admin_functions(request) -> Response:
 
     try:
-        act_map = {
-            "prune": code_pipeline._prune_container,
-            "setupfiles": code_pipeline._get_setup_files,
-            "containercount": code_pipeline._get_container_count,
-            "kill": code_pipeline._kill_container,
-            "reset": code_pipeline._reset_all
-        }
         act = request.path_params.get("action", None)
-        params = await request.json()
+        params = loads(await request.body())
         token = params.get('token', None)
         container = params.get('container', None)
 
         if token is not None and compare_digest(token, ADM_TOKEN):
-            do_act = act_map.get(act, None)
+            do_act = admin_actions.get(act, None)
 
             if do_act is not None:
-                resp = await do_act(cont=container)  # type: ignore
-                return JSONResponse(resp)
+                resp = await do_act(container=container)  # type: ignore
+                return FastJSONResponse(resp)
 
             else:
                 raise ValueError
 
         else:
-            return JSONResponse({
-                'result': "AuthError: Invalid or missing auth token.",
-                'status': "1"
-            })
+            return _respond(ADMIN_AUTH_ERROR)
 
     except(Error, TypeError, ValueError, JSONDecodeError):
-        return JSONResponse({
-            'result': "Error: Invalid/missing required parameters or endpoint.",
-            'status': "1"
-        })
+        return _respond(ADMIN_INVALID)
 
 routes: List[BaseRoute] = [
     Route('/run/{interpreter}', run_code, methods=['POST']),
+    Route('/run/{interpreter}/batch', run_batch, methods=['POST']),
+    Route('/run/{interpreter}/project', run_project, methods=['POST']),
     Route('/poll/{token}', check_result, methods=['GET']),
+    Route('/stream/{token}', stream_result, methods=['GET']),
     Route('/admin/{action}', admin_functions, methods=['POST']),
+    Route('/metrics', metrics, methods=['GET']),
+    Route('/healthz', health, methods=['GET']),
+    Route('/readyz', readiness, methods=['GET']),
 ]
 
 app = Starlette(debug=False, routes=routes, on_startup=[check_image])
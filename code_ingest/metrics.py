@@ -0,0 +1,134 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import threading
+from typing import Callable, Dict, List, Tuple, Union
+
+# Seconds, from a fast container start up to a run that used its whole lifetime.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    escape = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+    return tuple(sorted((name, str(value).translate(escape)) for name, value in labels.items()))
+
+
+class Counter():
+
+    # A count that only goes up, one series per set of labels.
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.series: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            series = list(self.series.items())
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter",
+                *(f"{self.name}{_format_labels(labels)} {value}" for labels, value in series)]
+
+
+class Gauge():
+
+    # A value read when the metrics are scraped, collect returns it per set of labels.
+
+    def __init__(self, name: str, help_text: str, collect: Callable[[], Dict[Labels, float]]):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                *(f"{self.name}{_format_labels(labels)} {value}" for labels, value in self.collect().items())]
+
+
+class Histogram():
+
+    # Cumulative bucket counts, the sum and the count of observations, one series per set of labels.
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series: Dict[Labels, List[float]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self.lock:
+            series = self.series.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        with self.lock:
+            series = [(labels, list(values)) for labels, values in self.series.items()]
+
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, values in series:
+            for bound, count in zip((*self.buckets, "+Inf"), (*values[:-2], values[-1])):
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(labels, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {values[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {values[-1]}")
+        return lines
+
+
+class Metrics():
+
+    # Everything /metrics exposes, rendered in the Prometheus text format. Each worker process keeps its own.
+
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Gauge, Histogram]] = {}
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        counter = Counter(name, help_text)
+        self.metrics[name] = counter
+        return counter
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], Dict[Labels, float]]) -> Gauge:
+        gauge = Gauge(name, help_text, collect)
+        self.metrics[name] = gauge
+        return gauge
+
+    def histogram(self, name: str, help_text: str) -> Histogram:
+        histogram = Histogram(name, help_text)
+        self.metrics[name] = histogram
+        return histogram
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
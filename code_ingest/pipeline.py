@@ -13,21 +13,77 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import hashlib
+import json
 import logging
+import math
 import secrets
 import tarfile
 import threading
 from base64 import b64encode
-from binascii import Error
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from distutils.dir_util import copy_tree
+from functools import partial
 from io import BytesIO
-from os import walk
+from os import scandir, walk
 from pathlib import Path
-from tempfile import NamedTemporaryFile, gettempdir
-from time import sleep
-from typing import Dict
+from tempfile import gettempdir
+from time import monotonic, sleep, time
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
 
 import docker
+import requests
+
+from .cache import ArtifactCache, ResultCache
+from .hosts import CPUSET_LABEL, INSTANCE_LABEL, DockerHost, HostPool, NoHostAvailableError
+from .metrics import Labels, Metrics
+from .results import Run
+from .scheduler import AdmissionQueue, QueueFullError, TimeoutScheduler
+from .store import MemoryStore, ResultStore
+from .streams import StreamReader, close_stream
+
+# Pooled containers idle on this until a submission drops its files and `.ready` in.
+POOL_WAIT_CMD = ("/bin/sh -c 'cd /home/ractf; while [ ! -f .ready ]; do sleep 0.1; done;"
+                 " exec sh ./.run.sh'")
+POOL_REFILL_INTERVAL = 5
+# Unix time after which a container is an orphan, whichever instance started it.
+EXPIRES_LABEL = "code_ingest.expires"
+# Slack on every expiry, so the reconciler never races a container that is only just finishing.
+ORPHAN_GRACE = 60
+# Pooled containers are recycled before this age, so they never outlive their expiry label.
+POOL_MAX_AGE = 3600
+# Bulk removals run this many at a time on their own threads, never queueing behind or ahead of submissions.
+CLEANUP_BATCH = 16
+SETUP_RELOAD_INTERVAL = 1
+# CFS period used when a quota is applied to an already running pooled container.
+CPU_PERIOD = 100000
+# How long to wait before trying again when no host could get its images at startup.
+IMAGE_RETRY_INTERVAL = 30
+# How often running output is copied to the shared store, and how often other workers check it.
+STORE_PUBLISH_INTERVAL = 0.2
+STORE_POLL_INTERVAL = 0.25
+# Finished runs the admin stats action aggregates over.
+USAGE_HISTORY = 1000
+# Containers sampled for resource usage at once. Sampling has its own threads so it never delays a submission.
+STATS_CONCURRENCY = 4
+# Build cache misses compiled at once. A build waits up to a container lifetime, so it never holds a docker thread.
+BUILD_CONCURRENCY = 4
+# Runs the challenge's setup script as the sandbox user, then blanks it so the submission can't read it.
+SETUP_CMD = "chmod +x setup.sh && sh ./setup.sh; dd if=/dev/null of=setup.sh &>/dev/null"
+SNAPSHOT_LABEL = "code_ingest.setup"
+SNAPSHOT_CMD = ("/bin/sh -c 'cd /home/ractf; chmod +x setup.sh && sh ./setup.sh;"
+                " dd if=/dev/null of=setup.sh &>/dev/null; rm -f setup.sh'")
+# What the build step of a compiled interpreter has to produce in the home directory.
+BUILD_ARTIFACT = "program"
+# Batch runs ship this runner and their cases into the sandbox. It runs as root and everything else as the
+# sandbox user, writing the case results where only root can, to be read back once the container exits.
+BATCH_RUNNER = ".batch.py"
+BATCH_CASES = ".cases.json"
+BATCH_RESULTS = "/var/batch-results.json"
+# Isolated mode, so nothing in the home directory can be imported into the runner.
+BATCH_CMD = f"python3 -I {BATCH_RUNNER}"
 
 
 class DockerPipeline():
@@ -35,30 +91,151 @@ class DockerPipeline():
     def __init__(self, **container_config):
 
         self.container_config = container_config
-        self.docker_client = docker.from_env()
-        self.result_dict = {}
-        self.setup_dir = {}
+        # Every container we start is labelled with this, so its events can be told apart from others.
+        self.instance_id = container_config.get("instance_id", None) or secrets.token_hex(8)
+        self.docker_concurrency = container_config.get("docker_concurrency", 16)
+        # Runs are spread over every configured daemon, by default just the local one.
+        self.hosts = HostPool(self.__connect_hosts(),
+                              docker.utils.parse_bytes(container_config.get("mem_max", None) or "0"))
+        # Every daemon call made from the event loop goes through this, capping concurrent calls.
+        self.docker_executor = ThreadPoolExecutor(max_workers=self.docker_concurrency,
+                                                  thread_name_prefix="docker")
+        # One thread reads every running container's output, so the thread count doesn't grow with the runs.
+        self.streams = StreamReader(self.__on_output, self.__on_stream_closed)
+        # Runs this worker owns. Their records are published to the store for every other worker.
+        self.result_dict: Dict[str, Run] = {}
+        self.store: ResultStore = container_config.get("store", None) or MemoryStore()
+        self.store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+        self.setup_dir: Dict[str, str] = {}
+        self.setup_code: Dict[str, bytes] = {}
+        self.setup_signature: Tuple = ()
+        self.setup_checked = 0.0
         self.base_dir = Path(gettempdir()) / "ingest_server"
         self.inst_path = Path(__file__).parent
         self.req_dir: Path = Path("./setup-code")
+        self.pool: Dict[str, Deque] = {}
+        self.pool_target: Dict[str, int] = {}
+        self.pool_lock = threading.Lock()
+        self.pool_event = threading.Event()
+        self.pool_thread: Optional[threading.Thread] = None
+        self.timeouts = TimeoutScheduler(self._expire_containers)
+        self.expiry = TimeoutScheduler(self._expire_results)
+        self.admission = AdmissionQueue(container_config.get("max_running", 0),
+                                        container_config.get("max_queued", 100),
+                                        container_config.get("tenant_max_running", 0),
+                                        container_config.get("tenant_max_queued", 0),
+                                        container_config.get("tenant_weights", None))
+        self.spawn_tasks: Set[asyncio.Future] = set()
+        self.complete_lock = threading.Lock()
+        self.events_threads: Dict[str, threading.Thread] = {}
+        self.stats_interval = container_config.get("stats_interval", 1.0)
+        self.stats_event = threading.Event()
+        self.stats_thread: Optional[threading.Thread] = None
+        self.stats_executor = ThreadPoolExecutor(max_workers=STATS_CONCURRENCY, thread_name_prefix="stats")
+        self.stats_one_shot = True
+        self.reconcile_interval = container_config.get("reconcile_interval", 60)
+        self.reconcile_thread: Optional[threading.Thread] = None
+        self.cleanup_executor = ThreadPoolExecutor(max_workers=CLEANUP_BATCH, thread_name_prefix="cleanup")
+        self.build_executor = ThreadPoolExecutor(max_workers=BUILD_CONCURRENCY, thread_name_prefix="build")
+        self.images_ready = False
+        self.pool_warm = False
+        self.startup_task: Optional[asyncio.Future] = None
+        self.usage_log: Deque[Tuple[str, Dict[str, float], bool, bool]] = deque(maxlen=USAGE_HISTORY)
+        # Image ids and snapshots differ between daemons, so both are keyed by (host name, image or hash).
+        self.image_ids: Dict[Tuple[str, str], str] = {}
+        self.snapshots: Dict[Tuple[str, str], str] = {}
+        self.snapshots_building: Set[Tuple[str, str]] = set()
+        self.snapshot_lock = threading.Lock()
+        build_cache_max = container_config.get("build_cache_max", 0)
+        self.artifacts = ArtifactCache(build_cache_max) if build_cache_max > 0 else None
+        self.batch_runner = (self.inst_path / "batch_runner.py").read_bytes()
+        self.metrics = Metrics()
+        self.decode_seconds = self.metrics.histogram(
+            "code_ingest_request_decode_seconds", "Time spent reading and decoding a submission.")
+        self.queue_seconds = self.metrics.histogram(
+            "code_ingest_queue_wait_seconds", "Time a submission waited for a free slot.")
+        self.start_seconds = self.metrics.histogram(
+            "code_ingest_container_start_seconds", "Time to create or claim, fill and start a container.")
+        self.exec_seconds = self.metrics.histogram(
+            "code_ingest_execution_seconds", "Time from a container starting until it exited.")
+        self.log_seconds = self.metrics.histogram(
+            "code_ingest_log_fetch_seconds", "Time from a container exiting until its output was drained.")
+        self.cleanup_seconds = self.metrics.histogram(
+            "code_ingest_cleanup_seconds", "Time to remove a finished container.")
+        self.metrics.gauge("code_ingest_running_containers", "Containers running submissions.", self.__count_running)
+        self.metrics.gauge("code_ingest_pooled_containers", "Idle containers waiting in the pool.", self.__count_pooled)
+        self.metrics.gauge("code_ingest_busy_cores", "Cores with at least one run pinned to them.",
+                           self.__count_busy_cores)
+        self.metrics.gauge("code_ingest_threads", "Threads open in this worker.",
+                           lambda: {(): threading.active_count()})
+        self.timeouts_total = self.metrics.counter("code_ingest_timeouts_total", "Runs killed at their time limit.")
+        self.oom_total = self.metrics.counter("code_ingest_oom_kills_total", "Runs killed for running out of memory.")
+        self.truncated_total = self.metrics.counter(
+            "code_ingest_truncated_outputs_total", "Runs whose output was cut off at the output cap.")
+        result_cache_max = container_config.get("result_cache_max", 0)
+        self.results = (ResultCache(result_cache_max, container_config.get("result_cache_ttl", 300))
+                        if result_cache_max > 0 else None)
 
-        if not self.base_dir.exists():
-            self.base_dir.mkdir()
+    def __connect_hosts(self) -> List[DockerHost]:
+        clients = self.container_config.get("docker_clients", None)
+        if clients is None:
+            clients = {
+                url: docker.DockerClient(base_url=url, max_pool_size=self.docker_concurrency)
+                for url in self.container_config.get("docker_hosts", ())
+            } or {"local": docker.from_env(max_pool_size=self.docker_concurrency)}
+        return [DockerHost(name, client, self.instance_id) for name, client in clients.items()]
 
-    async def pull_image(self, img_name, *tokens) -> None:
+    def _image_for(self, interpreter) -> str:
+        image = self.container_config.get("interpreter_images", {}).get(interpreter, None)
+        return image[0] if image is not None else self.container_config["image_name"]
+
+    def __images(self) -> Dict[str, Optional[str]]:
+        # Image name to the Alpine packages it installs, None builds the Dockerfile's full default set.
+        images: Dict[str, Optional[str]] = {self.container_config["image_name"]: None}
+        for image, packages in self.container_config.get("interpreter_images", {}).values():
+            images[image] = packages
+        return images
+
+    def __ensure_image(self, host, image, packages) -> bool:
         try:
-            self.docker_client.images.get(img_name)
-            logging.info("Image found, skipping build.")
+            host.client.images.get(image)
+            logging.info(f"Image {image} found on {host.name}, skipping build.")
+            return False
         except(docker.errors.ImageNotFound):
-            logging.info("Image not found or image changed, will build now, please wait.")
+            logging.info(f"Image {image} not found or image changed on {host.name}, will build now, please wait.")
             logging.info("This will only happen once, but may take a few minutes.")
-            self.docker_client.images.build(
+            host.client.images.build(
                 path=str(self.inst_path.parent / "docker-build"),
-                tag=f"{self.container_config.get('image_name', img_name)}:latest",
+                tag=f"{image}:latest",
+                buildargs={"PACKAGES": packages} if packages is not None else None,
                 rm=True
             )
-            self.docker_client.images.remove("alpine")
-            logging.info("Docker Image built successfully.")
+            logging.info(f"Docker Image {image} built successfully on {host.name}.")
+            return True
+
+    async def pull_image(self, img_name, *tokens) -> None:
+        try:
+            images = self.__images()
+            for host in self.hosts.hosts:
+                # The daemon builds every missing image side by side, sharing the base layers between them.
+                built = await asyncio.gather(*(
+                    self._docker_call(self.__ensure_image, host, image, packages)
+                    for image, packages in images.items()
+                ), return_exceptions=True)
+
+                failed = [result for result in built if isinstance(result, BaseException)]
+                if failed:
+                    logging.error(f"Docker host {host.name} failed to build its images, skipping it for now.",
+                                  exc_info=failed[0])
+                    host.mark_down()
+                    continue
+
+                host.images_ready = host.healthy = True
+                if any(built):
+                    try:
+                        await self._docker_call(host.client.images.remove, "alpine")
+                    except(docker.errors.APIError):
+                        ...
 
         finally:
             if tokens[0]:
@@ -66,20 +243,198 @@ class DockerPipeline():
             else:
                 logging.info("CODE_INGEST_SPLASH_TOKENS is set, will not display admin tokens.")
 
-    def cp_bytes(self, src, dst, container_token, bytes_obj=True) -> None:
+    async def __prepare(self, img_name, *tokens) -> None:
+        self.hosts.watch()
+        self.__start_event_listeners()
+        while not self.images_ready:
+            await self.pull_image(img_name, *tokens)
+            # Hosts that failed to build are marked down, one good host is enough to start taking runs.
+            self.images_ready = bool(self.hosts.healthy())
+            if not self.images_ready:
+                logging.error(f"No Docker host has the images yet, trying again in {IMAGE_RETRY_INTERVAL}s.")
+                await asyncio.sleep(IMAGE_RETRY_INTERVAL)
+
+        await self.warm_pool()
+        await self.collect_snapshots()
+        await self.start_reconciler()
+        logging.info("Images are ready, accepting submissions.")
+
+    def start(self, img_name, *tokens) -> None:
+        # Builds and warm-up carry on in the background, so the server takes connections straight away.
+        if self.startup_task is None:
+            self.startup_task = asyncio.ensure_future(self.__prepare(img_name, *tokens))
 
-        # Create our in-memory tarfile
+    def readiness(self) -> Dict[str, str]:
+        if not self.pool_warm:
+            pool_min = self.container_config.get("pool_min", 0)
+            if max(self.container_config.get("pool_max", 0), pool_min) <= 0:
+                self.pool_warm = True
+            elif self.pool_thread is not None:
+                # Only the first fill counts, so a pool drained by load doesn't flap the server out of service.
+                with self.pool_lock:
+                    self.pool_warm = all(len(self.pool.get(interpreter, ())) >= pool_min
+                                         for interpreter in self.pool_target)
+
+        docker_up = bool(self.hosts.healthy())
+        return {
+            "status": "0" if self.images_ready and docker_up and self.pool_warm else "1",
+            "image": "0" if self.images_ready else "1",
+            "docker": "0" if docker_up else "1",
+            "pool": "0" if self.pool_warm else "1",
+        }
+
+    def ready(self) -> bool:
+        return self.readiness()["status"] == "0"
+
+    async def _docker_call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.docker_executor, partial(func, *args, **kwargs))
+
+    async def _store_call(self, func, *args):
+        if not self.store.blocking:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.store_executor, partial(func, *args))
+
+    def __record(self, run: Run, queue: Optional[int] = None) -> Dict:
+        if not run.done:
+            run.expires = time() + ((run.lifetime or self.container_config["container_lifetime"])
+                                    + self.container_config.get("result_ttl", 60))
+
+        # Copy the buffers, the log follower may still be appending to them.
+        record = run.to_record(queue)
+        record["output"] = bytes(record["output"])
+        record["chunks"] = list(record["chunks"])
+        return record
+
+    def _publish(self, runs: List[Run], queued: bool = False) -> None:
+
+        # Safe from any thread, store writes happen in order on the store's own thread.
+        records = {
+            run.token: self.__record(run, self.admission.position(run.token) if queued else None)
+            for run in runs
+        }
+        if self.store.blocking:
+            self.store_executor.submit(self.store.put_many, records).add_done_callback(self.__log_store_failure)
+        else:
+            self.store.put_many(records)
+
+    @staticmethod
+    def __log_store_failure(future) -> None:
+        # Nothing waits on a publish, so a failed write would otherwise vanish with its future.
+        error = future.exception()
+        if error is not None:
+            logging.error("Failed to publish runs to the result store.", exc_info=error)
+
+    def _sandbox_args(self, lifetime=None, cpuset=None) -> Dict:
+        expires = time() + (lifetime or self.container_config["container_lifetime"]) + ORPHAN_GRACE
+        labels = {INSTANCE_LABEL: self.instance_id, EXPIRES_LABEL: str(int(expires))}
+        if cpuset is not None:
+            labels[CPUSET_LABEL] = cpuset
+        return {
+            "network_disabled": self.container_config['disable_network'],
+            "network_mode": self.container_config['net'],
+            "mem_limit": self.container_config['mem_max'],
+            "memswap_limit": self.container_config['mem_max'],
+            "tty": self.container_config['use_tty'],
+            "stop_signal": "SIGINT",
+            "user": "ractf",
+            "labels": labels,
+            "isolation": "default",
+            "security_opt": ["no-new-privileges"],
+        }
+
+    @staticmethod
+    def _build_archive(files: Dict[str, bytes]) -> bytes:
+
+        # Create our in-memory tarfile, entries are extracted in insertion order.
         in_mem_tarfile = BytesIO()
-        __in_mem_code = BytesIO(src)
-        tar_info = tarfile.TarInfo("script")
-        tar_info.size = len(src)
-        __tar_manager = tarfile.open(fileobj=in_mem_tarfile, mode="w")
-        __tar_manager.addfile(tar_info, __in_mem_code)
-        __tar_manager.close()
+        with tarfile.open(fileobj=in_mem_tarfile, mode="w") as tar_manager:
+            for name, data in files.items():
+                tar_info = tarfile.TarInfo(name)
+                tar_info.size = len(data)
+                tar_info.mode = 0o755
+                tar_info.uid = tar_info.gid = 1000
+                tar_manager.addfile(tar_info, BytesIO(data))
+
+        return in_mem_tarfile.getvalue()
 
-        # Put the archive in the container with format docker-py wants.
-        container_dst = self.docker_client.containers.get(container_token)
-        container_dst.put_archive(dst, in_mem_tarfile.getvalue())
+    def __create_pooled_container(self, interpreter) -> None:
+        host = self.hosts.place()
+        container = host.client.containers.run(
+            self._image_for(interpreter),
+            POOL_WAIT_CMD,
+            remove=self.container_config['auto_remove'],
+            detach=True,
+            name=f"pool-{secrets.token_hex(8)}",
+            **self._sandbox_args(POOL_MAX_AGE)
+        )
+        with self.pool_lock:
+            self.pool.setdefault(interpreter, deque()).append((host, container, time() + POOL_MAX_AGE))
+
+    def __retire_pooled_containers(self) -> None:
+        # Containers too close to their expiry to take a default run are replaced by fresh ones.
+        retire_by = time() + self.container_config["container_lifetime"]
+        with self.pool_lock:
+            retired = [entry for pool in self.pool.values() for entry in pool if entry[2] < retire_by]
+            for pool in self.pool.values():
+                for entry in retired:
+                    if entry in pool:
+                        pool.remove(entry)
+        if retired:
+            self.__remove_containers([entry[1] for entry in retired])
+
+    def __refill_pool(self) -> None:
+        while True:
+            self.__retire_pooled_containers()
+            for interpreter, target in list(self.pool_target.items()):
+                try:
+                    while len(self.pool.get(interpreter, ())) < target:
+                        self.__create_pooled_container(interpreter)
+                except(docker.errors.APIError, docker.errors.ImageNotFound, NoHostAvailableError, OSError):
+                    logging.exception(f"Failed to refill the {interpreter} container pool.")
+
+            self.pool_event.wait(POOL_REFILL_INTERVAL)
+            self.pool_event.clear()
+
+    def __drop_pooled_container(self, name) -> None:
+        with self.pool_lock:
+            for pool in self.pool.values():
+                for entry in pool:
+                    if entry[1].name == name:
+                        pool.remove(entry)
+                        self.pool_event.set()
+                        return None
+
+    def __claim_pooled_container(self, interpreter, host, lifetime):
+        with self.pool_lock:
+            pool = self.pool.get(interpreter, ())
+            entry = next((entry for entry in pool if entry[0] is host and entry[2] - time() > lifetime), None)
+            if entry is None:
+                # A miss means demand outgrew the pool, so grow it towards the max.
+                if interpreter in self.pool_target:
+                    self.pool_target[interpreter] = min(self.pool_target[interpreter] + 1,
+                                                        self.container_config.get("pool_max", 0))
+                    self.pool_event.set()
+                return None
+            pool.remove(entry)
+
+        self.pool_event.set()
+        return entry[1]
+
+    async def warm_pool(self) -> None:
+        pool_min = self.container_config.get("pool_min", 0)
+        pool_max = max(self.container_config.get("pool_max", 0), pool_min)
+        self.container_config["pool_max"] = pool_max
+
+        if pool_max <= 0 or self.pool_thread is not None:
+            return None
+
+        for interpreter in self.container_config.get("pool_interpreters", ()):
+            self.pool_target[interpreter] = pool_min
+        self.pool_thread = threading.Thread(target=self.__refill_pool, daemon=True)
+        self.pool_thread.start()
+        logging.info(f"Warming container pools ({pool_min}-{pool_max} per interpreter).")
 
     async def _build_map(self) -> None:
 
@@ -89,173 +444,1027 @@ class DockerPipeline():
             copy_tree(str(src_dir), str(self.req_dir))
             logging.info("Creating setup-code directory in working dir.")
 
+        self.__load_setup_code()
+
+    def __setup_signature(self) -> Tuple:
+        with scandir(self.req_dir) as entries:
+            return tuple(sorted((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                                for entry in entries if entry.is_file()))
+
+    def __load_setup_code(self) -> None:
+        signature = self.__setup_signature()
         path, dirs, files = next(walk(self.req_dir))
 
+        setup_dir = {}
+        setup_code = {}
         for i in enumerate(files):
-            self.setup_dir[str(i[0])] = i[1]
+            setup_dir[str(i[0])] = i[1]
+            with open(str(self.req_dir / i[1]), "rb") as s_code:
+                setup_code[i[1]] = s_code.read()
+
+        self.setup_dir, self.setup_code, self.setup_signature = setup_dir, setup_code, signature
+        self.setup_checked = monotonic()
 
-    def __manage_container_timeout(self, container_token) -> None:
-        sleep(self.container_config["container_lifetime"])
-        container, sf, cf = self.result_dict.get(container_token, [None, None, None])
+    def _get_setup_code(self, setup_code) -> bytes:
+
+        # Setup scripts are served from memory, the directory is only re-read once something in it changes.
+        if monotonic() - self.setup_checked > SETUP_RELOAD_INTERVAL:
+            self.setup_checked = monotonic()
+            if self.__setup_signature() != self.setup_signature:
+                self.__load_setup_code()
+                logging.info("Setup code changed, reloaded it.")
+                if self.container_config.get("snapshots", False):
+                    self.docker_executor.submit(self.__collect_snapshots)
+
+        return self.setup_code.get(self.setup_dir.get(setup_code, "0blank.sh"), b"")
+
+    def __expire_container(self, container_token) -> None:
+        run = self.result_dict.get(container_token, None)
+        if run is None or run.done:
+            return None
+
+        run.timed_out = True
         try:
-            if container is not None:
-                container.reload()
-                if container.attrs["State"]["Running"]:
-                    container.kill()
-                container.remove()
-                logging.info(f"Removed {container_token} as it timed out.")
-                del self.result_dict[container_token]
+            # The log follower sees the stream end and cleans up, or kills the container
+            # itself if the run was still being spawned.
+            if run.container is not None:
+                run.container.kill()
+                logging.info(f"Killed {container_token} as it timed out.")
+
+        except(docker.errors.APIError):
+            # It is already dead, so its die event went missing. Read the exit code directly instead.
+            run.timed_out = False
+            try:
+                run.container.reload()
+                run.exit_code = run.container.attrs["State"]["ExitCode"]
+                run.exited = run.exited or monotonic()
+            except(docker.errors.APIError):
+                run.exit_code = 1
+            run.stream_closed = True
+            self.__maybe_complete(run)
+
+        return None
+
+    async def _expire_containers(self, tokens: List[str]) -> None:
+        await asyncio.gather(*(self._docker_call(self.__expire_container, token) for token in tokens))
+        for token in tokens:
+            self.admission.release(token)
+
+    async def _expire_results(self, tokens: List[str]) -> None:
+        for token in tokens:
+            self.result_dict.pop(token, None)
+            await self._store_call(self.store.delete, token)
+        await self._store_call(self.store.purge)
+
+    def _finish_run(self, container_token) -> None:
+        self.timeouts.cancel(container_token)
+        if self.admission.release(container_token) and self.admission.waiting:
+            # Everyone behind a freed slot moved up the queue.
+            self._publish([self.result_dict[token] for token in list(self.admission.waiting)
+                           if token in self.result_dict], queued=True)
+
+    def __count_running(self) -> Dict[Labels, float]:
+        running: Dict[Labels, float] = {}
+        for run in list(self.result_dict.values()):
+            if run.started and not run.done:
+                labels = (("interpreter", str(run.interpreter)),)
+                running[labels] = running.get(labels, 0) + 1
+        return running
 
-                if sf.exists():
-                    sf.unlink()
+    def __count_pooled(self) -> Dict[Labels, float]:
+        with self.pool_lock:
+            return {(("interpreter", interpreter),): len(pool) for interpreter, pool in self.pool.items()}
 
-                if cf.exists():
-                    cf.unlink()
+    def __count_busy_cores(self) -> Dict[Labels, float]:
+        return {(("host", host.name),): len(host.cores) - host.free_cores() for host in self.hosts.hosts}
 
+    def __claim_cores(self, host) -> Tuple[Optional[str], Dict]:
+        # Each run is pinned to the host's least busy cores and held to a quota, so one busy loop can't slow
+        # down every other run on the host.
+        cpus = self.container_config.get("cpus_per_run", 0)
+        if cpus <= 0:
+            return None, {}
+
+        cpuset = host.claim_cores(math.ceil(cpus))
+        cpu_args: Dict[str, Any] = {"nano_cpus": int(min(cpus, len(host.cores) or cpus) * 1e9)}
+        if cpuset is not None:
+            cpu_args["cpuset_cpus"] = cpuset
+        return cpuset, cpu_args
+
+    def __release_cores(self, run: Run) -> None:
+        host = self.hosts.get(run.host)
+        if run.cpuset is not None and host is not None:
+            host.release_cores(run.cpuset)
+        run.cpuset = None
+
+    def _complete_run(self, run: Run) -> None:
+        # Runs served from the result cache never started a container, so they aren't counted.
+        if run.started:
+            interpreter = str(run.interpreter)
+            self.usage_log.append((interpreter, run.usage(), run.timed_out, run.oom_killed))
+            if run.timed_out:
+                self.timeouts_total.inc(interpreter=interpreter)
+            if run.oom_killed:
+                self.oom_total.inc(interpreter=interpreter)
+            if run.truncated:
+                self.truncated_total.inc(interpreter=interpreter)
+
+        # Only runs whose container started and exited are memoized, failed spawns and cache hits never reached one.
+        # Timeouts and OOM kills depend on the host's load, so those aren't either.
+        cleanly = run.started and run.exited and not (run.timed_out or run.oom_killed)
+        if self.results is not None and run.cache_key is not None and cleanly:
+            self.results.put(run.cache_key, run.snapshot())
+
+        run.finished.set()
+        run.expires = time() + self.container_config.get("result_ttl", 60)
+        self._publish([run])
+        run.notify()
+        self._finish_run(run.token)
+        self.expiry.schedule(run.token, self.container_config.get("result_ttl", 60))
+
+    def __attach(self, container):
+        # The raw socket rather than docker-py's blocking iterator, so the stream reader can select over it.
+        return container.client.api.attach_socket(container.id, params={"stdout": 1, "stderr": 1, "stream": 1,
+                                                                        "logs": 1})
+
+    def __follow_logs(self, run: Run, stream) -> None:
+
+        # The single log stream per container, every poll and subscriber reads from the run buffer.
+        if run.timed_out:
+            self.__expire_container(run.token)
+        run.published = monotonic()
+        self.streams.add(stream, run.token, self.container_config['use_tty'])
+
+    def __on_output(self, token: str, name: str, data: bytes) -> bool:
+        run = self.result_dict.get(token, None)
+        if run is None:
+            return False
+
+        output_max = self.container_config.get("output_max", 0)
+        if output_max > 0 and len(run.output) + len(data) > output_max:
+            data = data[:output_max - len(run.output)]
+            run.truncated = True
+        if data:
+            run.append_output(name, data)
+        run.notify_threadsafe()
+
+        if monotonic() - run.published >= STORE_PUBLISH_INTERVAL:
+            run.published = monotonic()
+            self._publish([run])
+
+        if run.truncated:
+            # Stop reading here, so a flood of output never costs more than output_max bytes.
+            logging.info(f"Output of {run.token} hit the {output_max} byte cap.")
+            if self.container_config.get("kill_on_output_max", True):
+                self.cleanup_executor.submit(self.__kill_quietly, run.container)
+            return False
+        return True
+
+    def __on_stream_closed(self, token: str) -> None:
+        run = self.result_dict.get(token, None)
+        if run is None:
+            return None
+        run.drained = monotonic()
+        run.stream_closed = True
+        self.__maybe_complete(run)
+
+    @staticmethod
+    def __kill_quietly(container) -> None:
+        try:
+            container.kill()
         except(docker.errors.NotFound, docker.errors.APIError):
-            pass
+            ...
+
+    def __maybe_complete(self, run: Run) -> None:
+
+        # A run is over once its output is drained and its die event has given us the exit code.
+        with self.complete_lock:
+            if run.completing or run.exit_code is None or not run.stream_closed:
+                return None
+            run.completing = True
+
+        # Completion covers timeouts and failed starts too, so this is the one place cores are handed back.
+        self.__release_cores(run)
+
+        if run.started:
+            interpreter = str(run.interpreter)
+            exited = run.exited or monotonic()
+            self.exec_seconds.observe(exited - run.started, interpreter=interpreter)
+            if run.drained:
+                self.log_seconds.observe(max(run.drained - exited, 0), interpreter=interpreter)
+
+        if run.container is None:
+            run.loop.call_soon_threadsafe(self._complete_run, run)
+            return None
+
+        # Often called from a host's events thread, which mustn't wait on a removal before its next event.
+        self.cleanup_executor.submit(self.__remove_finished, run)
+        return None
+
+    def __remove_finished(self, run: Run) -> None:
+        try:
+            if run.batch:
+                run.cases = self.__read_batch_results(run.container)
+
+            removing = monotonic()
+            run.container.remove(force=True)
+            self.cleanup_seconds.observe(monotonic() - removing, interpreter=str(run.interpreter))
+        except(docker.errors.NotFound, docker.errors.APIError, requests.exceptions.ConnectionError,
+               requests.exceptions.Timeout):
+            ...
+        finally:
+            run.loop.call_soon_threadsafe(self._complete_run, run)
+
+    @staticmethod
+    def __read_batch_results(container) -> Optional[List]:
+        # Missing when the runner never got through every case, such as a failed build or a timeout.
+        try:
+            chunks, _ = container.get_archive(BATCH_RESULTS)
+            with tarfile.open(fileobj=BytesIO(b"".join(chunks))) as tar_manager:
+                member = tar_manager.extractfile(tar_manager.getmembers()[0])
+                return json.loads(member.read())["cases"] if member is not None else None
+        except(docker.errors.NotFound, docker.errors.APIError, tarfile.TarError, IndexError, ValueError,
+               KeyError, TypeError):
+            return None
+
+    def __handle_event(self, event) -> None:
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        name = attributes.get("name", "")
+        run = self.result_dict.get(name, None)
+
+        if run is None:
+            if name.startswith("pool-"):
+                self.__drop_pooled_container(name)
+            return None
+
+        action = event.get("Action", event.get("status"))
+        if action == "oom":
+            run.oom_killed = True
+        elif action == "die":
+            run.exited = monotonic()
+            run.exit_code = int(attributes.get("exitCode", 1))
+            self.__maybe_complete(run)
+
+    def __listen_events(self, host) -> None:
+        # Replay from when the listener started, so a container that dies before the stream opens isn't missed.
+        since = int(time())
+        filters = {
+            "type": "container",
+            "event": ["die", "oom"],
+            "label": f"{INSTANCE_LABEL}={self.instance_id}",
+        }
+        while True:
+            try:
+                for event in host.client.events(decode=True, since=since, filters=filters):
+                    # Resume from the last event seen if the stream drops, so none are missed.
+                    since = event.get("time", since)
+                    self.__handle_event(event)
+
+            except(docker.errors.APIError, OSError):
+                logging.exception(f"Lost the Docker events stream from {host.name}, reconnecting.")
+            sleep(1)
+
+    def __sample_stats(self, run: Run) -> None:
+        container = run.container
+        if container is None or run.exit_code is not None:
+            return None
+
+        try:
+            try:
+                stats = container.stats(stream=False, one_shot=self.stats_one_shot)
+            except(docker.errors.InvalidVersion, TypeError):
+                # Daemons older than API 1.41 can't skip the second sample, and docker-py before 6.0 has no
+                # one_shot at all, so each call takes a stats cycle.
+                self.stats_one_shot = False
+                stats = container.stats(stream=False)
+        except(docker.errors.NotFound, docker.errors.APIError, OSError):
+            return None
+
+        memory = stats.get("memory_stats") or {}
+        cpu_usage = (stats.get("cpu_stats") or {}).get("cpu_usage") or {}
+        # cgroup v1 reports its own peak, v2 only the current use, so the peak is the highest seen either way.
+        run.memory_peak = max(run.memory_peak, memory.get("max_usage", 0) or 0, memory.get("usage", 0) or 0)
+        run.cpu_ns = max(run.cpu_ns, cpu_usage.get("total_usage", 0) or 0)
+
+    def __collect_stats(self) -> None:
+        while True:
+            self.stats_event.wait(self.stats_interval)
+            self.stats_event.clear()
+            running = [run for run in list(self.result_dict.values())
+                       if run.container is not None and run.exit_code is None]
+            for sampled in [self.stats_executor.submit(self.__sample_stats, run) for run in running]:
+                try:
+                    sampled.result()
+                except(Exception):
+                    # One bad sample only costs that run its figures, the sampler keeps going.
+                    logging.exception("Failed to sample container stats.")
+
+    def _ensure_event_listener(self) -> None:
+        self.hosts.watch()
+        self.__start_reconciler()
+        if self.stats_interval > 0 and self.stats_thread is None:
+            self.stats_thread = threading.Thread(target=self.__collect_stats, daemon=True)
+            self.stats_thread.start()
+        self.__start_event_listeners()
+
+    def __start_event_listeners(self) -> None:
+        for host in self.hosts.hosts:
+            if host.name not in self.events_threads:
+                self.events_threads[host.name] = threading.Thread(target=self.__listen_events, args=(host,),
+                                                                  daemon=True)
+                self.events_threads[host.name].start()
+
+    def __image_id(self, host, image_name) -> str:
+        if (host.name, image_name) not in self.image_ids:
+            self.image_ids[(host.name, image_name)] = host.client.images.get(image_name).id
+        return self.image_ids[(host.name, image_name)]
+
+    @staticmethod
+    def __is_blank(setup_bytes) -> bool:
+        return not any(line.strip() and not line.strip().startswith(b"#") for line in setup_bytes.splitlines())
+
+    def __snapshot_hash(self, host, image, setup_bytes) -> str:
+        return hashlib.sha256(self.__image_id(host, image).encode() + b"\0" + setup_bytes).hexdigest()
 
+    def __build_snapshot(self, host, image, setup_hash, setup_bytes) -> None:
+        tag = f"{image}:setup-{setup_hash[:16]}"
+        try:
+            try:
+                host.client.images.get(tag)
+                logging.info(f"Reusing setup snapshot {tag} on {host.name}.")
+
+            except(docker.errors.ImageNotFound):
+                container = host.client.containers.create(
+                    image,
+                    SNAPSHOT_CMD,
+                    name=f"setup-{setup_hash[:16]}-{secrets.token_hex(4)}",
+                    **self._sandbox_args()
+                )
+                try:
+                    container.put_archive("/home/ractf", self._build_archive({"setup.sh": setup_bytes}))
+                    container.start()
+                    status = container.wait(timeout=self.container_config["container_lifetime"])
+                    if status.get("StatusCode", 1) != 0:
+                        logging.info(f"Setup script for {tag} failed, it will keep running per submission.")
+                        return None
+                    container.commit(repository=image, tag=f"setup-{setup_hash[:16]}",
+                                     changes=[f"LABEL {SNAPSHOT_LABEL}={setup_hash}"])
+                    logging.info(f"Built setup snapshot {tag} on {host.name}.")
+                finally:
+                    container.remove(force=True)
+
+            with self.snapshot_lock:
+                self.snapshots[(host.name, setup_hash)] = tag
+
+        except(docker.errors.APIError, OSError):
+            logging.exception(f"Failed to build setup snapshot {tag} on {host.name}.")
+
+        finally:
+            with self.snapshot_lock:
+                self.snapshots_building.discard((host.name, setup_hash))
+
+    def __snapshot_image(self, host, image, setup_bytes) -> Optional[str]:
+
+        # Runs wait for nothing, the first submission of a new script builds its snapshot in the background.
+        key = (host.name, self.__snapshot_hash(host, image, setup_bytes))
+        with self.snapshot_lock:
+            if key in self.snapshots:
+                return self.snapshots[key]
+            if key not in self.snapshots_building:
+                self.snapshots_building.add(key)
+                self.docker_executor.submit(self.__build_snapshot, host, image, key[1], setup_bytes)
         return None
 
-    def __spawn_threaded_container(self, exec_code, exec_method, container_token, ext, setup_code) -> None:
+    def __collect_snapshots(self) -> None:
+        for host in self.hosts.healthy():
+            try:
+                live = {self.__snapshot_hash(host, image, setup_bytes)
+                        for image in self.__images() for setup_bytes in self.setup_code.values()}
+                for image in host.client.images.list(filters={"label": SNAPSHOT_LABEL}):
+                    setup_hash = image.labels.get(SNAPSHOT_LABEL, "")
+                    if setup_hash in live:
+                        continue
+
+                    with self.snapshot_lock:
+                        self.snapshots.pop((host.name, setup_hash), None)
+                    try:
+                        host.client.images.remove(image.id)
+                        logging.info(f"Removed unused setup snapshot {image.tags} from {host.name}.")
+                    except(docker.errors.APIError):
+                        ...
+
+            except(docker.errors.APIError, OSError):
+                logging.exception(f"Failed to garbage collect setup snapshots on {host.name}.")
+
+    async def collect_snapshots(self) -> None:
+        if self.container_config.get("snapshots", False):
+            await self._docker_call(self.__collect_snapshots)
+
+    def __result_key(self, exec_code, setup_code, interpreter, image, extra_files=None) -> str:
+        setup_bytes = self._get_setup_code(setup_code)
+        # Every host is built from the same Dockerfile, so any healthy one stands in for the image.
+        hosts = self.hosts.healthy() or self.hosts.hosts
+
+        return hashlib.sha256(b"\0".join((
+            str(interpreter).encode(),
+            hashlib.sha256(exec_code).hexdigest().encode(),
+            hashlib.sha256(setup_bytes).hexdigest().encode(),
+            self.__image_id(hosts[0], image).encode(),
+            *(hashlib.sha256(name.encode() + b"\0" + data).hexdigest().encode()
+              for name, data in sorted((extra_files or {}).items())),
+        ))).hexdigest()
 
+    def __build_artifact(self, run, host, exec_code, ext, build_cmd, interpreter) -> Optional[bytes]:
+        artifacts = self.artifacts
+        if artifacts is None:
+            return None
+
+        image_name = run.image
+        key = hashlib.sha256(b"\0".join((
+            interpreter.encode(), self.__image_id(host, image_name).encode(), build_cmd.encode(), exec_code
+        ))).hexdigest()
+
+        artifact = artifacts.get(key)
+        if artifact is not None:
+            logging.info(f"Build cache hit for {run.token}.")
+            return artifact
+
+        # Build in a throwaway container, so user code never gets to touch what ends up in the cache.
+        cpuset, cpu_args = self.__claim_cores(host)
         try:
-            sf = NamedTemporaryFile(dir=str(self.base_dir), delete=False)
-            cf = NamedTemporaryFile(dir=str(self.base_dir), delete=False)
-
-            code_dir = self.setup_dir.get(setup_code, "0blank.sh")
-            with open(str(self.req_dir / code_dir), "r") as s_code:
-                sf.write(s_code.read().encode())
-                sf.flush()
-
-            cf.write(exec_code)
-            cf.flush()
-
-            current_container = self.docker_client.containers.run(
-                self.container_config["image_name"],
-                exec_method,
-                network_disabled=self.container_config['disable_network'],
-                network_mode=self.container_config['net'],
-                remove=self.container_config['auto_remove'],
-                volumes={
-                    cf.name: {'bind': f'/home/ractf/{ext}', 'mode': 'ro'},
-                    sf.name: {'bind': '/home/ractf/setup.sh', 'mode': 'rw'}
-                },
-                mem_limit=self.container_config['mem_max'],
-                memswap_limit=self.container_config['mem_max'],
-                tty=self.container_config['use_tty'],
-                detach=True,
-                stop_signal="SIGINT",
-                user="ractf",
-                name=container_token,
-                isolation="default"
+            container = host.client.containers.create(
+                image_name,
+                f"/bin/sh -c 'cd /home/ractf; {build_cmd}'",
+                name=f"{run.token}-build",
+                **self._sandbox_args(cpuset=cpuset),
+                **cpu_args
             )
-            self.result_dict[container_token] = [current_container, Path(sf.name), Path(cf.name)]
-            current_container.reload()
+        except(docker.errors.APIError, OSError):
+            if cpuset is not None:
+                host.release_cores(cpuset)
+            raise
+
+        try:
+            container.put_archive("/home/ractf", self._build_archive({ext: exec_code}))
+            container.start()
+            if container.wait(timeout=self.container_config["container_lifetime"]).get("StatusCode", 1) != 0:
+                # Let the normal run show the compiler errors.
+                return None
+
+            chunks, stat = container.get_archive(f"/home/ractf/{BUILD_ARTIFACT}")
+            with tarfile.open(fileobj=BytesIO(b"".join(chunks))) as tar_manager:
+                member = tar_manager.extractfile(BUILD_ARTIFACT)
+                artifact = member.read() if member is not None else None
+
+        except(docker.errors.APIError, OSError, KeyError, tarfile.TarError):
+            logging.exception(f"Failed to build {run.token} for the build cache.")
             return None
 
-        except(docker.errors.ContainerError):
+        finally:
+            if cpuset is not None:
+                host.release_cores(cpuset)
+            try:
+                container.remove(force=True)
+            except(docker.errors.NotFound, docker.errors.APIError):
+                ...
+
+        if artifact is not None:
+            artifacts.put(key, artifact)
+        return artifact
+
+    def __prebuild(self, run, exec_code, ext, build_cmd, interpreter) -> Optional[bytes]:
+        try:
+            return self.__build_artifact(run, self.hosts.place(), exec_code, ext, build_cmd, interpreter)
+        except(NoHostAvailableError):
+            return None
+        except(Exception):
+            # The run still compiles for itself, it just misses the cache.
+            logging.exception(f"Build cache unavailable for {run.token}.")
             return None
 
+    def __start_pooled_container(self, run, host, exec_method, files, interpreter, cpu_args) -> bool:
+        container = self.__claim_pooled_container(interpreter, host, run.lifetime)
+        if container is None:
+            return False
+
+        stream = None
+        try:
+            container.rename(run.token)
+            if cpu_args:
+                # Pooled containers were started unpinned, a running container only takes a period and quota.
+                container.update(cpuset_cpus=cpu_args.get("cpuset_cpus", None), cpu_period=CPU_PERIOD,
+                                 cpu_quota=int(cpu_args["nano_cpus"] * CPU_PERIOD / 1e9))
+            stream = self.__attach(container)
+            container.put_archive("/home/ractf", self._build_archive({
+                **files,
+                ".run.sh": f"exec {exec_method}\n".encode(),
+                ".ready": b"",
+            }))
+            run.container = container
+            run.started = monotonic()
+            self.stats_event.set()
+            self.__follow_logs(run, stream)
+            return True
+
+        except(docker.errors.NotFound, docker.errors.APIError):
+            logging.info(f"Pooled container for {run.token} is gone, falling back to a cold start.")
+            if stream is not None:
+                close_stream(stream)
+            try:
+                container.remove(force=True)
+            except(docker.errors.NotFound, docker.errors.APIError):
+                ...
+            return False
+
+    def __spawn_on_host(self, run, host, exec_code, exec_method, ext, setup_bytes, interpreter, extra_files,
+                        archive) -> None:
+
+        # The setup script and code reach the container as one in-memory tar, nothing touches the disk.
+        # Uploaded projects arrive as their own archive instead, which goes in first.
+        files = {"setup.sh": setup_bytes, **({ext: exec_code} if archive is None else {}), **(extra_files or {})}
+        image_name = run.image
+
+        if self.container_config.get("snapshots", False) and not self.__is_blank(setup_bytes):
+            snapshot = self.__snapshot_image(host, run.image, setup_bytes)
+            if snapshot is not None:
+                # Setup already ran in the snapshot, so the run gets a blank script instead.
+                image_name = snapshot
+                files["setup.sh"] = b""
+
+        run.cpuset, cpu_args = self.__claim_cores(host)
+
+        # Pooled containers run the interpreter's own image and the plain run command, so snapshot runs and batch
+        # runs, which need the runner as their command, always start cold.
+        # Uploaded projects do too, a pooled container would start on whatever the upload unpacked first.
+        use_pool = image_name == self._image_for(interpreter) and not run.batch and archive is None
+        if use_pool and self.__start_pooled_container(run, host, exec_method, files, interpreter, cpu_args):
+            return None
+
+        sandbox_args = self._sandbox_args(run.lifetime, run.cpuset)
+        if run.batch:
+            # The runner drops to the sandbox user itself, and its results are read after exit.
+            sandbox_args["user"] = "root"
+        current_container = host.client.containers.create(
+            image_name,
+            exec_method,
+            auto_remove=self.container_config['auto_remove'] and not run.batch,
+            name=run.token,
+            **sandbox_args,
+            **cpu_args
+        )
+        run.container = current_container
+        if archive is not None:
+            archive.seek(0)
+            current_container.put_archive("/home/ractf", archive)
+        current_container.put_archive("/home/ractf", self._build_archive(files))
+
+        # Attach before starting so no output is missed, however quickly the code exits.
+        stream = self.__attach(current_container)
+        current_container.start()
+        run.started = monotonic()
+        self.stats_event.set()
+        self.__follow_logs(run, stream)
+
+    def __spawn_threaded_container(self, run, exec_code, exec_method, ext, setup_code, interpreter=None,
+                                   extra_files=None, archive=None) -> None:
+        try:
+            self.__spawn_with_retries(run, exec_code, exec_method, ext, setup_code, interpreter, extra_files, archive)
+        except(Exception):
+            # Whatever went wrong, the run is already in result_dict and has to finish, or it would never expire.
+            logging.exception(f"Unexpected error starting {run.token}.")
+            if not run.started:
+                run.exit_code = 1
+                run.stream_closed = True
+                self.__maybe_complete(run)
+        finally:
+            if archive is not None:
+                archive.close()
+
+    def __spawn_with_retries(self, run, exec_code, exec_method, ext, setup_code, interpreter, extra_files,
+                             archive) -> None:
+        setup_bytes = self._get_setup_code(setup_code)
+
+        try:
+            # A daemon that can't be reached is taken out of placement and the run moves to the next best one.
+            for _ in range(len(self.hosts.hosts)):
+                host = self.hosts.place()
+                run.host = host.name
+                try:
+                    self.__spawn_on_host(run, host, exec_code, exec_method, ext, setup_bytes, interpreter,
+                                         extra_files, archive)
+                    self.start_seconds.observe(run.started - run.dispatched, interpreter=str(interpreter))
+                    return None
+                except(requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    logging.exception(f"Lost Docker host {host.name} while starting {run.token}.")
+                    host.mark_down()
+                    self.__release_cores(run)
+                    run.container = None
+
+            logging.error(f"No Docker host could start {run.token}.")
+
+        except(docker.errors.ContainerError, docker.errors.APIError, docker.errors.ImageNotFound):
+            logging.exception(f"Failed to start container {run.token}.")
+        except(NoHostAvailableError):
+            logging.error(f"No healthy Docker host to start {run.token} on.")
+
+        run.exit_code = 1
+        run.stream_closed = True
+        self.__maybe_complete(run)
+        return None
+
+    @staticmethod
+    def __container_labels(container) -> Dict[str, str]:
+        # Listed containers only carry the summary fields, where the labels sit at the top level.
+        return container.attrs.get("Labels") or (container.attrs.get("Config") or {}).get("Labels") or {}
+
+    @staticmethod
+    def __container_name(container) -> str:
+        names = container.attrs.get("Names") or [container.attrs.get("Name", "")]
+        return names[0].lstrip("/")
+
+    def __labelled_containers(self) -> List:
+        found = []
+        for host in self.hosts.healthy():
+            try:
+                found.extend(host.client.containers.list(all=True, sparse=True, filters={"label": INSTANCE_LABEL}))
+            except(docker.errors.APIError, OSError):
+                logging.exception(f"Failed to list containers on {host.name}.")
+        return found
+
+    def __remove_containers(self, containers) -> int:
+        def remove(container) -> bool:
+            try:
+                container.remove(v=True, force=True)
+                return True
+            except(docker.errors.NotFound, docker.errors.APIError, OSError):
+                return False
+
+        removed = 0
+        for start in range(0, len(containers), CLEANUP_BATCH):
+            removed += sum(self.cleanup_executor.map(remove, containers[start:start + CLEANUP_BATCH]))
+        return removed
+
+    def __remove_stale_files(self, before) -> int:
+        # Runs no longer write temporary files, but older versions left them here after a crash.
+        if not self.base_dir.exists():
+            return 0
+
+        removed = 0
+        with scandir(self.base_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < before:
+                    Path(entry.path).unlink()
+                    removed += 1
+        return removed
+
+    def __is_orphan(self, container, now) -> bool:
+        labels = self.__container_labels(container)
+        expires = labels.get(EXPIRES_LABEL, None)
+        if expires is None:
+            # Started by a version that didn't label expiry, so only its own instance can still want it.
+            return labels.get(INSTANCE_LABEL, None) != self.instance_id
+        try:
+            return float(expires) < now
+        except(ValueError):
+            return True
+
+    def __reconcile(self) -> None:
+        now = time()
+        orphans = [container for container in self.__labelled_containers() if self.__is_orphan(container, now)]
+        removed = self.__remove_containers(orphans)
+        files = self.__remove_stale_files(now - ORPHAN_GRACE)
+        if removed or files:
+            logging.info(f"Removed {removed} orphaned containers and {files} stale files.")
+
+    def __reconcile_loop(self) -> None:
+        while True:
+            try:
+                self.__reconcile()
+            except(docker.errors.APIError, OSError):
+                logging.exception("Failed to clean up orphaned containers.")
+            sleep(self.reconcile_interval)
+
+    def __start_reconciler(self) -> None:
+        if self.reconcile_interval > 0 and self.reconcile_thread is None:
+            self.reconcile_thread = threading.Thread(target=self.__reconcile_loop, daemon=True)
+            self.reconcile_thread.start()
+
+    async def start_reconciler(self) -> None:
+        self.__start_reconciler()
+
+    def __prune(self) -> int:
+        # Stopped containers nobody is still reading, plus any orphans that are somehow still running.
+        now = time()
+        busy = {token for token, run in list(self.result_dict.items()) if not run.done}
+        stray = []
+        for container in self.__labelled_containers():
+            name = self.__container_name(container)
+            if name.startswith("setup-") and self.snapshots_building:
+                continue
+            if self.__is_orphan(container, now) or (container.status in ("exited", "dead")
+                                                    and name.split("-", 1)[0] not in busy):
+                stray.append(container)
+        return self.__remove_containers(stray)
+
     async def _prune_container(self, **kwargs) -> Dict[str, str]:
-        self.docker_client.containers.prune()
-        logging.info("Pruned stopped containers.")
-        return {'status': "0"}
+        removed = await self._docker_call(self.__prune)
+        logging.info(f"Pruned {removed} stopped containers.")
+        return {'status': "0", "removed": str(removed)}
 
     async def _kill_container(self, **kwargs) -> Dict[str, str]:
         token = kwargs.get("container", None)
         try:
-            if token is not None:
-                container = self.docker_client.containers.get(token)
-                container.kill()
-                container.remove()
-                logging.info(f"Killed container {token}")
+            if token is not None and self.admission.position(token) is not None:
+                self.admission.release(token)
+                self.result_dict.pop(token, None)
+                logging.info(f"Dropped queued run {token}")
                 return {'status': "0"}
-            else:
-                return {'status': "1", "result": "Container not found."}
+
+            elif token is not None:
+                # Try the host the run was placed on, falling back to asking every host.
+                run, record = await self.__lookup(token)
+                host = self.hosts.get(record.get("host", None) if record is not None else None)
+                for host in [host] if host is not None else self.hosts.healthy():
+                    try:
+                        container = await self._docker_call(host.client.containers.get, token)
+                    except(docker.errors.NotFound):
+                        continue
+                    await self._docker_call(container.kill)
+                    if token not in self.result_dict:
+                        await self._docker_call(container.remove)
+                    logging.info(f"Killed container {token} on {host.name}")
+                    return {'status': "0"}
+
+            logging.info("Container not found, not killing.")
+            return {'status': "1", "result": "Container not found."}
 
         except(docker.errors.NotFound):
             logging.info("Container not found, not killing.")
             return {'status': "1", "result": "Container not found."}
 
     async def _get_container_count(self, **kwargs) -> Dict[str, str]:
-        return {"number": str(len(self.result_dict)),
-                "real": str(len(self.docker_client.containers.list())),
+        per_host = {}
+        for host in self.hosts.healthy():
+            per_host[host.name] = len(await self._docker_call(host.client.containers.list))
+        return {"number": str(sum(1 for run in self.result_dict.values() if not run.done)),
+                "real": str(sum(per_host.values())),
+                "queued": str(len(self.admission.waiting)),
+                "hosts": str(per_host),
+                "status": "0"}
+
+    async def _flush_caches(self, **kwargs) -> Dict[str, str]:
+        results = self.results.clear() if self.results is not None else 0
+        artifacts = self.artifacts.clear() if self.artifacts is not None else 0
+        logging.info(f"Flushed {results} cached results and {artifacts} cached builds.")
+        return {"results": str(results), "builds": str(artifacts), "status": "0"}
+
+    async def _get_usage_stats(self, **kwargs) -> Dict[str, Any]:
+
+        # Averages and maxima per interpreter over the last USAGE_HISTORY runs this worker finished.
+        grouped: Dict[str, List[Tuple[Dict[str, float], bool, bool]]] = {}
+        for interpreter, usage, timed_out, oom_killed in list(self.usage_log):
+            grouped.setdefault(interpreter, []).append((usage, timed_out, oom_killed))
+
+        interpreters = {}
+        for interpreter, runs in grouped.items():
+            summary = {
+                "runs": str(len(runs)),
+                "timeouts": str(sum(1 for _, timed_out, _ in runs if timed_out)),
+                "oom": str(sum(1 for _, _, oom_killed in runs if oom_killed)),
+            }
+            for field in ("queue_time", "start_time", "exec_time", "cpu_time", "memory_peak"):
+                values = [usage[field] for usage, _, _ in runs if field in usage]
+                if values:
+                    summary.update(self._format_usage({"usage": {
+                        f"{field}_avg": sum(values) / len(values), f"{field}_max": max(values),
+                    }}))
+            interpreters[interpreter] = summary
+
+        return {"interpreters": interpreters, "status": "0"}
+
+    async def _get_tenant_stats(self, **kwargs) -> Dict[str, Any]:
+        return {"tenants": self.admission.stats(),
+                "running": str(len(self.admission.running)),
+                "queued": str(len(self.admission.waiting)),
+                "tenant_max_running": str(self.admission.tenant_max_running),
                 "status": "0"}
 
     async def _get_setup_files(self, **kwargs) -> Dict[str, str]:
         return {"files": str(self.setup_dir), "status": "0"}
 
-    async def _reset_all(self, **kwargs) -> Dict[str, str]:
-        cont_list = self.docker_client.containers.list()
-        for container in cont_list:
-            container.remove(v=True, force=True)
-        res = self.result_dict
+    def __reset_all(self) -> None:
+        # Every code_ingest container goes, but nothing else running on the daemon is touched.
+        runs = len(self.result_dict)
+        # Dropped runs never complete, so their cores are handed back here instead.
+        for run in list(self.result_dict.values()):
+            self.__release_cores(run)
+        self.result_dict.clear()
+        removed = self.__remove_containers(self.__labelled_containers())
+        logging.info(f"Removed {removed} containers and dropped {runs} runs")
 
-        try:
-            for container in self.result_dict:
-                self.result_dict[container][0].remove()
-                del self.result_dict[container]
-        except(RuntimeError):
-            ...
+        files = self.__remove_stale_files(float("inf"))
+        logging.info(f"Removed {files} files")
 
-        logging.info(f"Removed {len(cont_list)}/{len(res)} containers")
-        path, dirs, files = next(walk(Path(self.base_dir)))
-        for file in files:
-            c_file = self.base_dir / file
-            c_file.unlink()
-        logging.info(f"Removed {len(files)} files")
+    async def _reset_all(self, **kwargs) -> Dict[str, str]:
+        with self.pool_lock:
+            for pool in self.pool.values():
+                pool.clear()
+        self.pool_event.set()
+        self.admission.clear()
+        await self._docker_call(self.__reset_all)
         logging.info("Full reset complete")
         return {"status": "0"}
 
-    async def run_container(self, exec_code, exec_method, ext, setup) -> Dict[str, str]:
+    async def run_container(self, exec_code, exec_method, ext, setup, interpreter=None, build=None,
+                            extra_files=None, lifetime=None, batch=False,
+                            archive=None, tenant="", priority="normal") -> Dict[str, str]:
 
-        container_token = secrets.token_hex()
-        threading.Thread(target=self.__spawn_threaded_container,
-                         args=(exec_code, exec_method, container_token, ext, setup)).start()
-        threading.Thread(target=self.__manage_container_timeout,
-                         args=(container_token,)).start()
-        logging.info(f"Started container {container_token}")
+        self._ensure_event_listener()
+        run = Run(secrets.token_hex())
+        run.batch = batch
+        run.interpreter = interpreter
+        run.lifetime = lifetime or self.container_config["container_lifetime"]
+        # The batch runner needs python3, which only the full image is sure to have.
+        run.image = self.container_config["image_name"] if batch else self._image_for(interpreter)
+        run.submitted = monotonic()
 
-        return {'token': container_token}
+        # Uploaded projects aren't hashed, the archive is only read once it reaches a container.
+        if self.results is not None and archive is None:
+            run.cache_key = await self._docker_call(self.__result_key, exec_code, setup, interpreter, run.image,
+                                                    extra_files)
+            cached = self.results.get(run.cache_key)
+            if cached is not None:
+                run.restore(cached)
+                self.result_dict[run.token] = run
+                self._complete_run(run)
+                logging.info(f"Served {run.token} from the result cache.")
+                return {'token': run.token}
 
-    async def poll_result(self, container_token) -> Dict[str, str]:
-        error_json = {"result": "Error: Invalid Token, Please Try Again", "status_code": "1", "done": "1"}
-        timeout_json = {"result": "Error: Your code timed out.", "status_code": "1", "done": "0", "timeout": "0"}
+        async def spawn() -> None:
+            method, files = exec_method, extra_files
+            if build is not None and self.artifacts is not None:
+                # Builds wait on their own threads, and their time doesn't come out of the run's lifetime.
+                build_cmd, artifact_method = build
+                artifact = await asyncio.get_running_loop().run_in_executor(
+                    self.build_executor, self.__prebuild, run, exec_code, ext, build_cmd, interpreter
+                )
+                if artifact is not None:
+                    method, files = artifact_method, {**(extra_files or {}), BUILD_ARTIFACT: artifact}
+            self.timeouts.schedule(run.token, run.lifetime)
+            await self._docker_call(self.__spawn_threaded_container, run, exec_code, method, ext, setup, interpreter,
+                                    files, archive)
+
+        def start() -> None:
+            run.dispatched = monotonic()
+            self.queue_seconds.observe(run.dispatched - run.submitted, interpreter=str(interpreter))
+            task = asyncio.ensure_future(spawn())
+            self.spawn_tasks.add(task)
+            task.add_done_callback(self.spawn_tasks.discard)
+            self._publish([run])
+            logging.info(f"Started container {run.token}")
 
+        # Raises QueueFullError when the queue is full, the handler turns it into a 429.
+        self.result_dict[run.token] = run
         try:
+            self.admission.submit(run.token, start, tenant, priority)
+        except(QueueFullError):
+            del self.result_dict[run.token]
+            raise
 
-            container, sf, cf = self.result_dict.get(container_token, [None, None, None])
+        if self.admission.position(run.token) is not None:
+            self._publish([run], queued=True)
+        return {'token': run.token}
 
-            if container is not None:
-                container.reload()
-                log = b64encode(container.logs()).decode()
+    async def run_batch(self, exec_code, ext, setup, interpreter, run_cmd, build_cmd, cases,
+                        exec_method, build=None, tenant="", priority="normal") -> Dict[str, str]:
 
-                if container.attrs["State"]["Running"]:
-                    state = 1
-                    done = 1
+        # One container runs every case, so setup and the build are paid for once per submission.
+        output_max = self.container_config.get("output_max", 0)
+        spec = {
+            "setup": SETUP_CMD,
+            "results": BATCH_RESULTS,
+            "build": build_cmd,
+            "run": run_cmd,
+            "output_max": output_max,
+            "cases": [{"stdin": b64encode(stdin).decode(), "time_limit": time_limit} for stdin, time_limit in cases],
+        }
+        return await self.run_container(
+            exec_code, exec_method, ext, setup, interpreter, build,
+            extra_files={BATCH_RUNNER: self.batch_runner, BATCH_CASES: json.dumps(spec).encode()},
+            lifetime=self.container_config["container_lifetime"] + sum(time_limit for _, time_limit in cases),
+            batch=True,
+            tenant=tenant,
+            priority=priority,
+        )
 
-                else:
-                    state = container.attrs["State"]["ExitCode"]
-                    done = 0
-                    container.remove()
-                    del self.result_dict[container_token]
+    async def run_project(self, archive, exec_method, setup, interpreter, tenant="",
+                          priority="normal") -> Dict[str, str]:
+        # The pipeline owns the archive from here and closes it once a container has it.
+        return await self.run_container(b"", exec_method, None, setup, interpreter, archive=archive, tenant=tenant,
+                                        priority=priority)
 
-                    if sf is not None and sf.exists():
-                        sf.unlink()
-                    if cf is not None and cf.exists():
-                        cf.unlink()
+    @staticmethod
+    def _batch_result(record) -> Optional[Dict]:
 
-                return {
-                    "result": log,
-                    "status_code": str(state),
-                    "done": str(done),
-                }
+        # The output is only what setup and the build printed, the cases come from the runner's results file.
+        if record.get("cases") is None:
+            return None
+        return {"result": b64encode(bytes(record["output"])).decode(), "cases": record["cases"]}
+
+    @staticmethod
+    def _format_usage(record) -> Dict[str, str]:
+        # Seconds for the times and CPU, bytes for the memory peak.
+        return {field: (f"{value:.4f}" if not field.startswith("memory_peak") else str(int(value)))
+                for field, value in (record.get("usage") or {}).items()}
+
+    async def __lookup(self, container_token) -> Tuple[Optional[Run], Optional[Dict]]:
 
+        # Runs this worker owns are answered from memory, anyone else's from the shared store.
+        run = self.result_dict.get(container_token, None)
+        if run is not None:
+            return run, run.to_record(self.admission.position(container_token))
+        return None, await self._store_call(self.store.get, container_token)
+
+    async def poll_result(self, container_token, wait=0, since=None) -> Dict[str, str]:
+        error_json = {"result": "Error: Invalid Token, Please Try Again", "status_code": "1", "done": "1"}
+        timeout_json = {"result": "Error: Your code timed out.", "status_code": "1", "done": "0", "timeout": "0"}
+        if since is not None and since < 0:
+            raise ValueError
+
+        run, record = await self.__lookup(container_token)
+        deadline = monotonic() + min(wait, self.container_config["container_lifetime"])
+        # With an offset the wait ends as soon as there is anything new to send, not only once the run is done.
+        while (record is not None and record["state"] != "done" and monotonic() < deadline
+               and (since is None or len(record["output"]) <= since)):
+            if run is not None and since is not None:
+                await run.wait_update(deadline - monotonic())
+            elif run is not None:
+                await run.wait_finished(deadline - monotonic())
             else:
-                return error_json
+                await asyncio.sleep(STORE_POLL_INTERVAL)
+            run, record = await self.__lookup(container_token)
 
-        except(KeyError, ValueError, Error):
+        if record is None:
             return error_json
-        except(docker.errors.NotFound, docker.errors.ContainerError, docker.errors.APIError):
-            return timeout_json
+
+        if record["state"] == "queued":
+            return {"result": "", "status_code": "1", "done": "1", "queue": str(record["queue"])}
+
+        usage = self._format_usage(record)
+        if record["timed_out"]:
+            return {**timeout_json, **usage}
+
+        done = record["state"] == "done"
+        batch = self._batch_result(record) if done and record.get("batch") else None
+        if batch is not None:
+            return {**batch, "status_code": str(record["exit_code"]), "done": "0",
+                    **({"oom": "0"} if record["oom_killed"] else {}), **usage}
+
+        # Output is only ever appended to, so an offset from an earlier poll still points at the same byte.
+        output = record["output"]
+        end = len(output)
+        return {
+            "result": b64encode(output[min(since or 0, end):end]).decode(),
+            "offset": str(end),
+            "status_code": str(record["exit_code"]) if done else "1",
+            "done": "0" if done else "1",
+            **({"truncated": "0"} if record["truncated"] else {}),
+            **({"oom": "0"} if record["oom_killed"] else {}),
+            **usage,
+        }
+
+    async def stream_result(self, container_token) -> AsyncIterator[Tuple[str, Dict[str, str]]]:
+        sent = 0
+        while True:
+            run, record = await self.__lookup(container_token)
+            if record is None:
+                yield "error", {"result": "Error: Invalid Token, Please Try Again", "status_code": "1", "done": "1"}
+                return
+
+            # The record is taken before sending, anything appended after it is picked up next time round.
+            chunks, output = record["chunks"], record["output"]
+            while sent < len(chunks):
+                stream, begin, end = chunks[sent]
+                sent += 1
+                yield stream, {"result": b64encode(output[begin:end]).decode()}
+
+            if record["state"] == "done":
+                batch = self._batch_result(record) if record.get("batch") else None
+                yield "exit", {
+                    **({"cases": batch["cases"]} if batch is not None else {}),
+                    "status_code": str(record["exit_code"]),
+                    "done": "0",
+                    **({"timeout": "0"} if record["timed_out"] else {}),
+                    **({"truncated": "0"} if record["truncated"] else {}),
+                    **({"oom": "0"} if record["oom_killed"] else {}),
+                    **self._format_usage(record),
+                }
+                return
+
+            if record["state"] == "queued":
+                yield "queue", {"queue": str(record["queue"])}
+
+            if run is not None:
+                await run.wait_update()
+            else:
+                await asyncio.sleep(STORE_POLL_INTERVAL)
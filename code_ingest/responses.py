@@ -0,0 +1,51 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+from base64 import b64encode
+from typing import Any, Dict
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except(ImportError):
+    orjson = None  # type: ignore
+
+
+def loads(body: bytes) -> Any:
+    # Request bodies must be a JSON object, anything else is as invalid as bad JSON.
+    params = orjson.loads(body) if orjson is not None else json.loads(body)
+    if not isinstance(params, dict):
+        raise ValueError
+    return params
+
+
+def prerender(content: Dict[str, str]) -> bytes:
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def prerender_error(message: bytes) -> bytes:
+    return prerender({"result": b64encode(message).decode()})
+
+
+class FastJSONResponse(JSONResponse):
+
+    # Encodes with orjson when it's installed, the output is the same compact JSON either way.
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content)
+        return super().render(content)
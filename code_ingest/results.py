@@ -0,0 +1,151 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class Run():
+
+    # Everything the pipeline knows about one submission, from queueing until its result expires.
+
+    def __init__(self, token: str):
+        self.token = token
+        self.loop = asyncio.get_running_loop()
+        self.container: Any = None
+        # Name of the Docker host the run was placed on.
+        self.host: Optional[str] = None
+        self.output = bytearray()
+        # (stream, start, end) offsets into output, in the order the chunks arrived.
+        self.chunks: List[Tuple[str, int, int]] = []
+        self.exit_code: Optional[int] = None
+        self.timed_out = False
+        self.truncated = False
+        self.oom_killed = False
+        self.stream_closed = False
+        self.completing = False
+        self.cache_key: Optional[str] = None
+        # Batch runs report per-case results, read from the runner's results file once the container exits.
+        self.batch = False
+        self.cases: Optional[List[Dict[str, str]]] = None
+        self.interpreter: Optional[str] = None
+        # Seconds the container may run for, longer than the default for batch runs.
+        self.lifetime = 0.0
+        # The image the run's container starts from, before any setup snapshot is applied.
+        self.image: Optional[str] = None
+        # The cores the run's container is pinned to, handed back to the host once it finishes.
+        self.cpuset: Optional[str] = None
+        # Monotonic times the run was submitted, left the queue, had its container started, exited and was drained.
+        self.submitted = 0.0
+        self.dispatched = 0.0
+        self.started = 0.0
+        self.exited = 0.0
+        self.drained = 0.0
+        # Highest CPU time (ns) and memory use (bytes) seen in the container's stats while it ran.
+        self.cpu_ns = 0
+        self.memory_peak = 0
+        # Monotonic time its output was last copied to the shared store while it ran.
+        self.published = 0.0
+        # Wall clock time the shared store may forget this run at.
+        self.expires = 0.0
+        self.finished = asyncio.Event()
+        self.updated = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.finished.is_set()
+
+    def append_output(self, stream: str, data: bytes) -> None:
+        start = len(self.output)
+        self.output += data
+        self.chunks.append((stream, start, len(self.output)))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "output": bytes(self.output),
+            "chunks": list(self.chunks),
+            "exit_code": self.exit_code,
+            "truncated": self.truncated,
+            "cases": self.cases,
+        }
+
+    def usage(self) -> Dict[str, float]:
+        usage: Dict[str, float] = {}
+        if self.dispatched:
+            usage["queue_time"] = self.dispatched - self.submitted
+        if self.started:
+            usage["start_time"] = self.started - self.dispatched
+        if self.started and self.exited:
+            usage["exec_time"] = self.exited - self.started
+        if self.cpu_ns:
+            usage["cpu_time"] = self.cpu_ns / 1e9
+        if self.memory_peak:
+            usage["memory_peak"] = self.memory_peak
+        return usage
+
+    def to_record(self, queue: Optional[int] = None) -> Dict[str, Any]:
+        if self.done:
+            state = "done"
+        elif queue is not None:
+            state = "queued"
+        else:
+            state = "running"
+
+        return {
+            "state": state,
+            "queue": queue,
+            "output": self.output,
+            "chunks": self.chunks,
+            "exit_code": self.exit_code,
+            "timed_out": self.timed_out,
+            "truncated": self.truncated,
+            "oom_killed": self.oom_killed,
+            "expires": self.expires,
+            "host": self.host,
+            "batch": self.batch,
+            "cases": self.cases,
+            "usage": self.usage() if self.done else {},
+        }
+
+    def restore(self, snapshot: Dict[str, Any]) -> None:
+        self.output = bytearray(snapshot["output"])
+        self.chunks = list(snapshot["chunks"])
+        self.exit_code = snapshot["exit_code"]
+        self.truncated = snapshot["truncated"]
+        self.cases = snapshot.get("cases")
+        self.stream_closed = True
+        self.completing = True
+
+    def notify(self) -> None:
+        # Wake everyone waiting on this update, later waiters get a fresh event.
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    def notify_threadsafe(self) -> None:
+        self.loop.call_soon_threadsafe(self.notify)
+
+    async def wait_update(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self.updated.wait(), timeout)
+            return True
+        except(asyncio.TimeoutError):
+            return False
+
+    async def wait_finished(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self.finished.wait(), timeout)
+            return True
+        except(asyncio.TimeoutError):
+            return False
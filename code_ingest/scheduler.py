@@ -0,0 +1,227 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import heapq
+import logging
+import math
+from collections import deque
+from time import monotonic
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+
+class QueueFullError(Exception):
+    ...
+
+
+class TimeoutScheduler():
+
+    # One task tracks every container deadline, instead of a sleeping thread per container.
+
+    def __init__(self, on_expire: Callable[[List[str]], Awaitable[None]]):
+        self.on_expire = on_expire
+        self.deadlines: Dict[str, float] = {}
+        self.heap: List[Tuple[float, str]] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.ensure_future(self.__run())
+
+    def schedule(self, token: str, delay: float) -> None:
+        # A NaN deadline never compares as due and would sit on top of the heap, blocking every other expiry.
+        if not math.isfinite(delay):
+            raise ValueError(f"Deadline for {token} must be finite, got {delay}.")
+        self.start()
+        deadline = monotonic() + delay
+        self.deadlines[token] = deadline
+        heapq.heappush(self.heap, (deadline, token))
+
+        # Only wake the loop when the new deadline is the earliest one.
+        if self.heap[0][1] == token and self.wakeup is not None:
+            self.wakeup.set()
+
+    def cancel(self, token: str) -> None:
+        # Stale heap entries are skipped when they come up, so no need to touch the heap here.
+        self.deadlines.pop(token, None)
+
+    def __pop_expired(self) -> List[str]:
+        now = monotonic()
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, token = heapq.heappop(self.heap)
+            if self.deadlines.get(token) == deadline:
+                del self.deadlines[token]
+                expired.append(token)
+        return expired
+
+    async def __run(self) -> None:
+        assert self.wakeup is not None
+        while True:
+            expired = self.__pop_expired()
+            if expired:
+                try:
+                    await self.on_expire(expired)
+                except Exception:
+                    logging.exception("Failed to expire timed out containers.")
+
+            delay = self.heap[0][0] - monotonic() if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except(asyncio.TimeoutError):
+                ...
+
+
+# Priority classes a run can be submitted with, lower goes first. Checker runs always go ahead of normal ones.
+PRIORITY_CLASSES = {"checker": 0, "normal": 1}
+# Tenants with nothing queued whose finish tags fell behind the virtual clock are forgotten past this many.
+TENANT_HISTORY = 1024
+
+
+class AdmissionQueue():
+
+    # Caps concurrently running containers, anything over the cap waits in a bounded queue. Each priority class is
+    # served strictly in order, and within a class tenants share the slots by weight (weighted fair queuing).
+
+    def __init__(self, max_running: int, max_queued: int, tenant_max_running: int = 0, tenant_max_queued: int = 0,
+                 tenant_weights: Optional[Dict[str, float]] = None):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.tenant_max_running = tenant_max_running
+        self.tenant_max_queued = tenant_max_queued
+        self.tenant_weights = tenant_weights or {}
+        # Running tokens and the tenant each belongs to.
+        self.running: Dict[str, str] = {}
+        self.tenant_running: Dict[str, int] = {}
+        # Queued tokens and their (priority, finish tag, sequence, tenant), the first three give dispatch order.
+        self.waiting: Dict[str, Tuple[int, float, int, str]] = {}
+        self.queues: Dict[Tuple[int, str], Deque[Tuple[str, float, Callable[[], None]]]] = {}
+        self.finish_tags: Dict[str, float] = {}
+        self.virtual_time = 0.0
+        self.sequence = 0
+
+    def __has_capacity(self) -> bool:
+        return self.max_running <= 0 or len(self.running) < self.max_running
+
+    def __tenant_has_capacity(self, tenant: str) -> bool:
+        return self.tenant_max_running <= 0 or self.tenant_running.get(tenant, 0) < self.tenant_max_running
+
+    def __tenant_queued(self, tenant: str) -> int:
+        return sum(len(queue) for (priority, queued_tenant), queue in self.queues.items() if queued_tenant == tenant)
+
+    def __start(self, token: str, tenant: str, start: Callable[[], None]) -> None:
+        self.running[token] = tenant
+        self.tenant_running[tenant] = self.tenant_running.get(tenant, 0) + 1
+        start()
+
+    def __dispatch(self) -> None:
+        while self.__has_capacity():
+            best: Optional[Tuple[int, float, int, str]] = None
+            for (priority, tenant), queue in self.queues.items():
+                if self.__tenant_has_capacity(tenant):
+                    key = self.waiting[queue[0][0]]
+                    if best is None or key < best:
+                        best = key
+            if best is None:
+                return None
+
+            priority, finish, sequence, tenant = best
+            queue = self.queues[(priority, tenant)]
+            token, start_tag, start = queue.popleft()
+            if not queue:
+                del self.queues[(priority, tenant)]
+            del self.waiting[token]
+            self.virtual_time = max(self.virtual_time, start_tag)
+            self.__start(token, tenant, start)
+
+        return None
+
+    def __forget_idle_tenants(self) -> None:
+        if len(self.finish_tags) > TENANT_HISTORY:
+            queued = {tenant for priority, tenant in self.queues}
+            for tenant, finish in list(self.finish_tags.items()):
+                if finish <= self.virtual_time and tenant not in queued:
+                    del self.finish_tags[tenant]
+
+    def submit(self, token: str, start: Callable[[], None], tenant: str = "", priority: str = "normal") -> None:
+        # Dispatch leaves nothing startable waiting, so a free slot means nobody eligible is ahead of this run.
+        if self.__has_capacity() and self.__tenant_has_capacity(tenant):
+            self.__start(token, tenant, start)
+            return None
+        if len(self.waiting) >= self.max_queued or 0 < self.tenant_max_queued <= self.__tenant_queued(tenant):
+            raise QueueFullError
+
+        # A tenant's next run is tagged one share after its last, so heavy tenants fall behind light ones.
+        start_tag = max(self.virtual_time, self.finish_tags.get(tenant, 0.0))
+        finish = start_tag + 1 / self.tenant_weights.get(tenant, 1.0)
+        self.finish_tags[tenant] = finish
+        self.sequence += 1
+        self.waiting[token] = (PRIORITY_CLASSES[priority], finish, self.sequence, tenant)
+        self.queues.setdefault((PRIORITY_CLASSES[priority], tenant), deque()).append((token, start_tag, start))
+        self.__forget_idle_tenants()
+        self.__dispatch()
+
+    def position(self, token: str) -> Optional[int]:
+        # Where the run would be served if no tenant were held back by its cap.
+        key = self.waiting.get(token, None)
+        if key is None:
+            return None
+        return sum(1 for other in self.waiting.values() if other < key) + 1
+
+    def release(self, token: str) -> bool:
+        if token in self.running:
+            tenant = self.running.pop(token)
+            self.tenant_running[tenant] -= 1
+            if not self.tenant_running[tenant]:
+                del self.tenant_running[tenant]
+
+        elif token in self.waiting:
+            priority, finish, sequence, tenant = self.waiting.pop(token)
+            queue = self.queues[(priority, tenant)]
+            for entry in queue:
+                if entry[0] == token:
+                    queue.remove(entry)
+                    break
+            if not queue:
+                del self.queues[(priority, tenant)]
+            return True
+
+        else:
+            return False
+
+        self.__dispatch()
+        return True
+
+    def stats(self) -> Dict[str, Dict[str, str]]:
+        tenants: Dict[str, Dict[str, str]] = {}
+        for tenant in set(self.tenant_running) | {tenant for priority, tenant in self.queues}:
+            tenants[tenant] = {
+                "running": str(self.tenant_running.get(tenant, 0)),
+                "queued": str(self.__tenant_queued(tenant)),
+                "checker_queued": str(len(self.queues.get((PRIORITY_CLASSES["checker"], tenant), ()))),
+                "weight": str(self.tenant_weights.get(tenant, 1.0)),
+            }
+        return tenants
+
+    def clear(self) -> None:
+        self.running.clear()
+        self.tenant_running.clear()
+        self.waiting.clear()
+        self.queues.clear()
+        self.finish_tags.clear()
+        self.virtual_time = 0.0
@@ -0,0 +1,140 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from time import time
+from typing import Any, Dict, Optional
+
+
+class ResultStore(ABC):
+
+    # Where run records live so any worker can answer for any token. Records are plain dicts, with
+    # the raw output under "output" and everything else JSON serialisable.
+
+    # Whether calls can block on IO, in which case the pipeline keeps them off the event loop.
+    blocking = False
+
+    @abstractmethod
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def put_many(self, records: Dict[str, Dict[str, Any]]) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, token: str) -> None:
+        ...
+
+    @abstractmethod
+    def purge(self) -> int:
+        ...
+
+    def put(self, token: str, record: Dict[str, Any]) -> None:
+        self.put_many({token: record})
+
+
+class MemoryStore(ResultStore):
+
+    def __init__(self):
+        self.records: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            record = self.records.get(token, None)
+            return dict(record) if record is not None else None
+
+    def put_many(self, records: Dict[str, Dict[str, Any]]) -> None:
+        with self.lock:
+            for token, record in records.items():
+                self.records[token] = dict(record, output=bytes(record["output"]))
+
+    def delete(self, token: str) -> None:
+        with self.lock:
+            self.records.pop(token, None)
+
+    def purge(self) -> int:
+        now = time()
+        with self.lock:
+            expired = [token for token, record in self.records.items() if record.get("expires", now) < now]
+            for token in expired:
+                del self.records[token]
+        return len(expired)
+
+
+class SQLiteStore(ResultStore):
+
+    # Shares runs between every worker and process on the host that points at the same file.
+
+    blocking = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        with self.__connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "token TEXT PRIMARY KEY, record TEXT NOT NULL, output BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS runs_expires ON runs (expires)")
+
+    def __connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        row = self.__connection().execute(
+            "SELECT record, output FROM runs WHERE token = ?", (token,)
+        ).fetchone()
+        if row is None:
+            return None
+        record = json.loads(row[0])
+        record["output"] = bytes(row[1])
+        return record
+
+    def put_many(self, records: Dict[str, Dict[str, Any]]) -> None:
+        rows = []
+        for token, record in records.items():
+            fields = {key: value for key, value in record.items() if key != "output"}
+            rows.append((token, json.dumps(fields), bytes(record["output"]), record.get("expires", time())))
+
+        # One transaction, so readers see either none or all of these records change.
+        with self.__connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)", rows)
+
+    def delete(self, token: str) -> None:
+        with self.__connection() as conn:
+            conn.execute("DELETE FROM runs WHERE token = ?", (token,))
+
+    def purge(self) -> int:
+        with self.__connection() as conn:
+            return conn.execute("DELETE FROM runs WHERE expires < ?", (time(),)).rowcount
+
+
+def open_store(spec: str) -> ResultStore:
+    if spec == "memory":
+        return MemoryStore()
+    elif spec.startswith("sqlite:"):
+        return SQLiteStore(spec[len("sqlite:"):])
+    raise ValueError(f"Unknown result store {spec!r}, expected 'memory' or 'sqlite:<path>'.")
@@ -0,0 +1,148 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import queue
+import selectors
+import socket
+import ssl
+import threading
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+READ_SIZE = 65536
+# Docker prefixes every chunk of a non-TTY attach stream with the stream it came from and its length.
+FRAME_HEADER = 8
+FRAME_STREAMS = {1: "stdout", 2: "stderr"}
+
+
+def close_stream(stream: Any) -> None:
+    # docker-py's socket wrapper only lets go of the socket inside once both are closed.
+    for closing in (stream, getattr(stream, "_sock", stream)):
+        try:
+            closing.close()
+        except(OSError):
+            ...
+
+
+class FrameParser():
+
+    # Splits an attach stream back into stdout and stderr, whatever sizes the reads come in.
+
+    def __init__(self, tty: bool):
+        self.tty = tty
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> Iterable[Tuple[str, bytes]]:
+        if self.tty:
+            return [("stdout", data)]
+
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= FRAME_HEADER:
+            size = int.from_bytes(self.buffer[4:FRAME_HEADER], "big")
+            if len(self.buffer) < FRAME_HEADER + size:
+                break
+            name = FRAME_STREAMS.get(self.buffer[0], None)
+            if name is not None and size:
+                frames.append((name, bytes(self.buffer[FRAME_HEADER:FRAME_HEADER + size])))
+            del self.buffer[:FRAME_HEADER + size]
+        return frames
+
+
+class StreamReader():
+
+    # Reads the output of every running container on one thread, however many runs are in flight. on_output gets
+    # each chunk and returns False to stop reading, on_closed is called once a stream is done either way.
+
+    def __init__(self, on_output: Callable[[Any, str, bytes], bool], on_closed: Callable[[Any], None]):
+        self.on_output = on_output
+        self.on_closed = on_closed
+        self.selector = selectors.DefaultSelector()
+        self.pending: queue.SimpleQueue = queue.SimpleQueue()
+        self.wakeup_read, self.wakeup_write = socket.socketpair()
+        self.wakeup_read.setblocking(False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, stream: Any, key: Any, tty: bool) -> None:
+        # Takes the socket docker-py hands back from attach_socket, or the socket inside it.
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, daemon=True, name="streams")
+                self.thread.start()
+        self.pending.put((stream, key, tty))
+        self.wakeup_write.send(b"\0")
+
+    def __register(self) -> None:
+        while not self.pending.empty():
+            stream, key, tty = self.pending.get()
+            sock = getattr(stream, "_sock", stream)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, (stream, key, FrameParser(tty)))
+
+    def __close(self, sock, stream, key) -> None:
+        self.selector.unregister(sock)
+        close_stream(stream)
+        self.on_closed(key)
+
+    def __read(self, sock, stream, key, parser: FrameParser) -> None:
+        try:
+            data = sock.recv(READ_SIZE)
+            # TLS may have decrypted more than one read asked for, which select won't report.
+            while isinstance(sock, ssl.SSLSocket) and sock.pending():
+                data += sock.recv(READ_SIZE)
+        except(BlockingIOError, ssl.SSLWantReadError):
+            return None
+        except(OSError):
+            logging.exception(f"Lost the log stream for {key}.")
+            data = b""
+
+        if not data:
+            self.__close(sock, stream, key)
+            return None
+
+        for name, chunk in parser.feed(data):
+            if not self.on_output(key, name, chunk):
+                self.__close(sock, stream, key)
+                return None
+
+    def __run(self) -> None:
+        while True:
+            events = self.selector.select()
+            for selected, _ in events:
+                if selected.fileobj is self.wakeup_read:
+                    try:
+                        self.wakeup_read.recv(READ_SIZE)
+                    except(BlockingIOError):
+                        ...
+                    self.__register()
+                    continue
+
+                stream, key, parser = selected.data
+                try:
+                    self.__read(selected.fileobj, stream, key, parser)
+                except(Exception):
+                    # One bad stream mustn't take every other run's output down with it.
+                    logging.exception(f"Failed to read the log stream for {key}.")
+                    if self.__registered(selected.fileobj):
+                        self.__close(selected.fileobj, stream, key)
+
+    def __registered(self, sock) -> bool:
+        try:
+            self.selector.get_key(sock)
+            return True
+        except(KeyError, ValueError):
+            return False
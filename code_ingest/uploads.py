@@ -0,0 +1,110 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import posixpath
+import tarfile
+import zlib
+from tempfile import SpooledTemporaryFile
+from typing import IO, AsyncIterator
+
+# Accepted project upload types, and whether each is gzip compressed.
+UPLOAD_TYPES = {
+    "application/x-tar": False,
+    "application/gzip": True,
+    "application/x-gzip": True,
+}
+# Uploads bigger than this are spooled to a temporary file rather than kept in memory.
+SPOOL_MAX = 1 << 20
+# Top level names the pipeline writes itself. Dotfiles are also refused there, as they drive the pooled and batch runs.
+RESERVED_NAMES = {"setup.sh"}
+# Owner of everything unpacked into the sandbox, the unprivileged ractf user.
+SANDBOX_UID = 1000
+
+
+class UploadTooLargeError(Exception):
+    ...
+
+
+async def spool_upload(chunks: AsyncIterator[bytes], compressed: bool, max_size: int) -> IO[bytes]:
+
+    # Only checks how big the archive unpacks to here, sanitize_upload reads the members once it's all in.
+    upload = SpooledTemporaryFile(max_size=SPOOL_MAX)
+    inflate = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None
+    received = unpacked = 0
+
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            if inflate is not None:
+                data = chunk
+                while data and not inflate.eof:
+                    unpacked += len(inflate.decompress(data, SPOOL_MAX))
+                    data = inflate.unconsumed_tail
+            else:
+                unpacked = received
+
+            if received > max_size or unpacked > max_size:
+                raise UploadTooLargeError
+            upload.write(chunk)
+
+        if not received or inflate is not None and not inflate.eof:
+            raise ValueError
+
+    except(zlib.error):
+        upload.close()
+        raise ValueError
+
+    except(UploadTooLargeError, ValueError):
+        upload.close()
+        raise
+
+    upload.seek(0)
+    return upload
+
+
+def _member_name(member: tarfile.TarInfo) -> str:
+    name = posixpath.normpath(member.name)
+    top = name.split("/", 1)[0]
+    if name.startswith("/") or top in ("..", ".") or top.startswith(".") or top in RESERVED_NAMES:
+        raise ValueError
+    return name
+
+
+def sanitize_upload(upload: IO[bytes]) -> IO[bytes]:
+
+    # Rewrites the upload as a plain tar of regular files and directories owned by the sandbox user, so it can't
+    # carry setuid binaries, links or device nodes, or replace the files the pipeline writes.
+    clean = SpooledTemporaryFile(max_size=SPOOL_MAX)
+    try:
+        with upload, tarfile.open(fileobj=upload, mode="r|*") as source, \
+                tarfile.open(fileobj=clean, mode="w") as target:
+            for member in source:
+                if not (member.isfile() or member.isdir()):
+                    raise ValueError
+                info = tarfile.TarInfo(_member_name(member))
+                info.type = member.type
+                info.size = member.size if member.isfile() else 0
+                info.mtime = member.mtime
+                info.mode = 0o755 if member.isdir() or member.mode & 0o111 else 0o644
+                info.uid = info.gid = SANDBOX_UID
+                info.uname = info.gname = "ractf"
+                target.addfile(info, source.extractfile(member) if member.isfile() else None)
+
+    except(tarfile.TarError, EOFError, zlib.error, ValueError):
+        clean.close()
+        raise ValueError
+
+    clean.seek(0)
+    return clean
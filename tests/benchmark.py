@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import asyncio
+import json
+import logging
+import random
+from pathlib import Path
+from sys import exit
+from time import monotonic
+from typing import Dict, List, Optional
+
+from code_ingest.pipeline import DockerPipeline
+from tests.fake_docker import FakeDockerClient
+
+IMAGE_NAME = "code-ingest-benchmark"
+CODE = b'print("Hello, World!")\n'
+
+
+def _percentile(samples: List[float], percent: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
+
+
+def _parse_mix(mix: str) -> Dict[str, float]:
+    # "python=3,gcc=1" sends three python submissions for every gcc one.
+    weights = {}
+    for part in mix.split(","):
+        interpreter, _, weight = part.partition("=")
+        weights[interpreter.strip()] = float(weight or 1)
+    return weights
+
+
+def _make_pipeline(args) -> DockerPipeline:
+    clients = {
+        f"fake-{index}": FakeDockerClient(
+            images=(IMAGE_NAME,),
+            create_latency=args.create_latency,
+            start_latency=args.start_latency,
+            run_latency=args.run_latency,
+            jitter=args.jitter,
+        )
+        for index in range(args.hosts)
+    }
+    pipeline = DockerPipeline(
+        image_name=IMAGE_NAME,
+        auto_remove=False,
+        container_lifetime=args.timeout,
+        disable_network=True,
+        net="none",
+        mem_max="24m",
+        use_tty=False,
+        output_max=1001,
+        pool_min=args.pool,
+        pool_max=args.pool,
+        pool_interpreters=list(_parse_mix(args.mix)),
+        docker_concurrency=args.docker_concurrency,
+        max_running=args.max_running,
+        max_queued=args.max_queued,
+        docker_clients=clients,
+    )
+    pipeline.req_dir = Path(__file__).parent.parent / "setup-code"
+    return pipeline
+
+
+async def _submit(pipeline: DockerPipeline, interpreter: str, latencies: List[float], failures: Dict[str, int],
+                  timeout: int) -> None:
+    submitted = monotonic()
+    try:
+        token = (await pipeline.run_container(CODE, f"run {interpreter}", "script", "0", interpreter))["token"]
+        result = await pipeline.poll_result(token, wait=timeout)
+        while result.get("done") == "1" and monotonic() - submitted < timeout * 2:
+            result = await pipeline.poll_result(token, wait=timeout)
+    except(Exception) as error:
+        failures[type(error).__name__] = failures.get(type(error).__name__, 0) + 1
+        return None
+
+    if result.get("timeout") is not None:
+        failures["timeout"] = failures.get("timeout", 0) + 1
+    elif result.get("status_code") != "0":
+        failures["error"] = failures.get("error", 0) + 1
+    else:
+        latencies.append(monotonic() - submitted)
+
+
+async def run_benchmark(args) -> Dict[str, float]:
+    pipeline = _make_pipeline(args)
+    await pipeline._build_map()
+    await pipeline.warm_pool()
+    if args.pool:
+        # Give the pool a moment to fill, cold pools are what --pool 0 measures.
+        await asyncio.sleep(max(args.start_latency + args.create_latency, 0.01) * args.pool + 0.5)
+
+    weights = _parse_mix(args.mix)
+    latencies: List[float] = []
+    failures: Dict[str, int] = {}
+    tasks = []
+
+    # Open-loop arrivals: submissions are sent on a Poisson schedule, whether or not earlier ones have finished.
+    started = monotonic()
+    for _ in range(args.requests):
+        interpreter = random.choices(list(weights), list(weights.values()))[0]  # noqa: S311
+        tasks.append(asyncio.ensure_future(_submit(pipeline, interpreter, latencies, failures, args.timeout)))
+        if args.rate > 0:
+            await asyncio.sleep(random.expovariate(args.rate))  # noqa: S311
+    await asyncio.gather(*tasks)
+    elapsed = monotonic() - started
+
+    return {
+        "requests": args.requests,
+        "completed": len(latencies),
+        "failed": sum(failures.values()),
+        **{f"failed_{reason}": count for reason, count in failures.items()},
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50": round(_percentile(latencies, 50), 4),
+        "p95": round(_percentile(latencies, 95), 4),
+        "p99": round(_percentile(latencies, 99), 4),
+        "max": round(max(latencies, default=0.0), 4),
+    }
+
+
+def _arguments(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Drive the pipeline against an in-process fake Docker daemon and report submit-to-result "
+                    "latency, so scheduling overhead can be measured without Docker."
+    )
+    parser.add_argument("-n", "--requests", type=int, default=500, help="Submissions to send (default 500)")
+    parser.add_argument("-r", "--rate", type=float, default=100,
+                        help="Mean arrivals per second, 0 sends everything at once (default 100)")
+    parser.add_argument("-m", "--mix", default="python=4,gcc=2,node=1,java=1",
+                        help="Interpreter weights, e.g. python=3,gcc=1")
+    parser.add_argument("--create-latency", type=float, default=0.01, help="Fake container create time (s)")
+    parser.add_argument("--start-latency", type=float, default=0.05, help="Fake container start time (s)")
+    parser.add_argument("--run-latency", type=float, default=0.1, help="Fake code run time (s)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random +/- fraction on each latency")
+    parser.add_argument("--hosts", type=int, default=1, help="Fake Docker hosts to spread runs over")
+    parser.add_argument("--pool", type=int, default=0, help="Pooled containers per interpreter")
+    parser.add_argument("--max-running", type=int, default=0, help="CODE_INGEST_MAX_RUNNING")
+    parser.add_argument("--max-queued", type=int, default=10000, help="CODE_INGEST_MAX_QUEUED")
+    parser.add_argument("--docker-concurrency", type=int, default=16, help="CODE_INGEST_DOCKER_CONCURRENCY")
+    parser.add_argument("--timeout", type=int, default=45, help="CODE_INGEST_TIMEOUT")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--max-p99", type=float, default=None,
+                        help="Exit with status 1 if p99 latency goes over this many seconds")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    args = _arguments(argv)
+    report = asyncio.run(run_benchmark(args))
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f"{key:>20}: {value}")
+
+    if report["failed"] or (args.max_p99 is not None and report["p99"] > args.max_p99):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import itertools
+import queue
+import random
+import socket
+import tarfile
+import threading
+from io import BytesIO
+from pathlib import PurePosixPath
+from time import sleep, time
+from typing import IO, Any, Dict, Iterator, List, Optional, Union
+
+import docker
+
+from code_ingest.pipeline import POOL_WAIT_CMD
+
+FAKE_OUTPUT = b"Hello, World!\n"
+FAKE_MEM_TOTAL = 64 << 30
+FAKE_CPUS = 16
+
+
+class FakeContainer():
+
+    # Runs nothing, it sleeps for the client's run latency once started and then exits 0 with FAKE_OUTPUT.
+
+    def __init__(self, client: "FakeDockerClient", image: str, command: str, name: str, labels: Dict[str, str]):
+        self.client = client
+        self.image = image
+        self.command = command
+        self.name = name
+        self.id = f"{next(client.ids):064x}"
+        self.labels = labels
+        self.files: Dict[str, bytes] = {}
+        self.status = "created"
+        self.exit_code = 0
+        self.finished = threading.Event()
+        # Write ends of the attach sockets, sent the output and closed once the container exits.
+        self.attached: List[socket.socket] = []
+        self.attrs: Dict[str, Any] = {
+            "Name": f"/{name}",
+            "Config": {"Labels": labels},
+            "State": {"Running": False, "ExitCode": 0, "OOMKilled": False},
+        }
+
+    def start(self) -> None:
+        self.client.delay(self.client.start_latency)
+        self.status = "running"
+        self.attrs["State"]["Running"] = True
+        # Pooled containers idle until a submission drops `.ready` in.
+        if self.command != POOL_WAIT_CMD:
+            threading.Thread(target=self.__run, daemon=True).start()
+
+    def __run(self) -> None:
+        self.client.delay(self.client.run_latency)
+        self.__exit(0)
+
+    def __exit(self, exit_code: int) -> None:
+        with self.client.lock:
+            if self.status != "running":
+                return None
+            self.status = "exited"
+        self.exit_code = exit_code
+        self.attrs["State"].update(Running=False, ExitCode=exit_code)
+        self.finished.set()
+        self.__flush_attached()
+        self.client.emit(self, "die", exitCode=str(exit_code))
+
+    def __flush_attached(self) -> None:
+        with self.client.lock:
+            attached, self.attached = self.attached, []
+        for writer in attached:
+            if self.exit_code == 0:
+                # Framed like a non-TTY attach stream, as stdout.
+                writer.sendall(b"\x01\0\0\0" + len(FAKE_OUTPUT).to_bytes(4, "big") + FAKE_OUTPUT)
+            writer.close()
+
+    def attach_socket(self) -> socket.socket:
+        reader, writer = socket.socketpair()
+        with self.client.lock:
+            self.attached.append(writer)
+        # Like attaching with logs, a container that already exited still replays its output.
+        if self.finished.is_set():
+            self.__flush_attached()
+        return reader
+
+    def put_archive(self, path: str, data: Union[bytes, IO[bytes]]) -> bool:
+        # Like Docker, takes the tar as bytes or a file, plain or compressed.
+        with tarfile.open(fileobj=BytesIO(data) if isinstance(data, bytes) else data) as tar_manager:
+            for member in tar_manager.getmembers():
+                extracted = tar_manager.extractfile(member)
+                self.files[member.name] = extracted.read() if extracted is not None else b""
+        if ".ready" in self.files and self.status == "running":
+            threading.Thread(target=self.__run, daemon=True).start()
+        return True
+
+    def get_archive(self, path: str):
+        # Anything the code would have written, such as a build artifact, reads back as FAKE_OUTPUT.
+        name = PurePosixPath(path).name
+        data = self.files.get(name, FAKE_OUTPUT)
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode="w") as tar_manager:
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = len(data)
+            tar_manager.addfile(tar_info, BytesIO(data))
+        return iter([archive.getvalue()]), {"name": name, "size": len(data)}
+
+    def wait(self, timeout: Optional[float] = None, **kwargs) -> Dict[str, int]:
+        self.finished.wait(timeout)
+        return {"StatusCode": self.exit_code}
+
+    def kill(self, **kwargs) -> None:
+        if self.status != "running":
+            raise docker.errors.APIError(f"Container {self.name} is not running")
+        self.__exit(137)
+
+    def remove(self, **kwargs) -> None:
+        if self.status == "running" and not kwargs.get("force", False):
+            raise docker.errors.APIError(f"Container {self.name} is running")
+        self.__exit(137)
+        self.status = "removed"
+        self.client.containers.forget(self)
+
+    def update(self, **kwargs) -> Dict[str, Any]:
+        return {"Warnings": None}
+
+    def rename(self, name: str) -> None:
+        self.client.containers.forget(self)
+        self.name = name
+        self.attrs["Name"] = f"/{name}"
+        self.client.containers.add(self)
+
+    def reload(self) -> None:
+        ...
+
+    def stats(self, stream: bool = True, **kwargs) -> Dict[str, Any]:
+        return {
+            "cpu_stats": {"cpu_usage": {"total_usage": 1000000}},
+            "memory_stats": {"usage": 1 << 20, "max_usage": 2 << 20},
+        }
+
+    def commit(self, repository: str, tag: str, changes=(), **kwargs) -> Any:
+        image = self.client.images.add(f"{repository}:{tag}")
+        for change in changes:
+            if change.startswith("LABEL "):
+                key, _, value = change[len("LABEL "):].partition("=")
+                image.labels[key] = value
+        return image
+
+
+class FakeContainers():
+
+    def __init__(self, client: "FakeDockerClient"):
+        self.client = client
+        self.by_name: Dict[str, FakeContainer] = {}
+
+    def add(self, container: FakeContainer) -> None:
+        with self.client.lock:
+            self.by_name[container.name] = container
+
+    def forget(self, container: FakeContainer) -> None:
+        with self.client.lock:
+            if self.by_name.get(container.name) is container:
+                del self.by_name[container.name]
+
+    def create(self, image: str, command: str, name: Optional[str] = None, labels=None, **kwargs) -> FakeContainer:
+        self.client.delay(self.client.create_latency)
+        if image not in self.client.images.tags:
+            raise docker.errors.ImageNotFound(f"No such image: {image}")
+        container = FakeContainer(self.client, image, command, name or f"fake-{next(self.client.ids)}",
+                                  dict(labels or {}))
+        self.add(container)
+        return container
+
+    def run(self, image: str, command: str, detach: bool = True, **kwargs) -> FakeContainer:
+        kwargs.pop("remove", None)
+        container = self.create(image, command, **kwargs)
+        container.start()
+        return container
+
+    def get(self, name: str) -> FakeContainer:
+        with self.client.lock:
+            container = self.by_name.get(name, None)
+        if container is None:
+            raise docker.errors.NotFound(f"No such container: {name}")
+        return container
+
+    def list(self, all: bool = False, filters=None, **kwargs) -> List[FakeContainer]:
+        with self.client.lock:
+            containers = list(self.by_name.values())
+        label = (filters or {}).get("label", None)
+        if label is not None:
+            # Like Docker, "key" matches any value and "key=value" only that one.
+            key, equals, value = label.partition("=")
+            containers = [container for container in containers
+                          if key in container.labels and (not equals or container.labels[key] == value)]
+        return [container for container in containers if all or container.status == "running"]
+
+    def prune(self, **kwargs) -> Dict[str, Any]:
+        removed = [container for container in self.list(all=True) if container.status == "exited"]
+        for container in removed:
+            container.remove(force=True)
+        return {"ContainersDeleted": [container.id for container in removed]}
+
+
+class FakeImage():
+
+    def __init__(self, tag: str):
+        self.tags = [tag]
+        self.id = f"sha256:{abs(hash(tag)):064x}"
+        self.labels: Dict[str, str] = {}
+
+
+class FakeImages():
+
+    def __init__(self):
+        self.tags: Dict[str, FakeImage] = {}
+
+    def add(self, tag: str) -> FakeImage:
+        tag = tag if ":" in tag else f"{tag}:latest"
+        image = self.tags.setdefault(tag, FakeImage(tag))
+        self.tags[tag.rsplit(":", 1)[0]] = image
+        return image
+
+    def get(self, tag: str) -> FakeImage:
+        image = self.tags.get(tag, None)
+        if image is None:
+            raise docker.errors.ImageNotFound(f"No such image: {tag}")
+        return image
+
+    def build(self, tag: str, **kwargs) -> FakeImage:
+        return self.add(tag)
+
+    def list(self, filters=None, **kwargs) -> List[FakeImage]:
+        label = (filters or {}).get("label", None)
+        images = {image.id: image for image in self.tags.values() if label is None or label in image.labels}
+        return list(images.values())
+
+    def remove(self, image: str, **kwargs) -> None:
+        for tag, found in list(self.tags.items()):
+            if image in (tag, found.id):
+                del self.tags[tag]
+
+
+class FakeDockerClient():
+
+    # Stands in for docker.DockerClient in the benchmark, with configurable latencies for each daemon call.
+
+    def __init__(self, images=(), create_latency: float = 0.0, start_latency: float = 0.0,
+                 run_latency: float = 0.0, jitter: float = 0.0):
+        self.create_latency = create_latency
+        self.start_latency = start_latency
+        self.run_latency = run_latency
+        self.jitter = jitter
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.containers = FakeContainers(self)
+        self.images = FakeImages()
+        for image in images:
+            self.images.add(image)
+        self.subscribers: List[queue.Queue] = []
+        # Stands in for the low level APIClient too, for the calls the pipeline makes through it.
+        self.api = self
+
+    def attach_socket(self, container_id: str, params=None) -> socket.socket:
+        with self.lock:
+            containers = [container for container in self.containers.by_name.values() if container.id == container_id]
+        if not containers:
+            raise docker.errors.NotFound(f"No such container: {container_id}")
+        return containers[0].attach_socket()
+
+    def delay(self, latency: float) -> None:
+        if latency > 0:
+            sleep(max(latency * (1 + random.uniform(-self.jitter, self.jitter)), 0))  # noqa: S311
+
+    def emit(self, container: FakeContainer, action: str, **attributes: str) -> None:
+        event = {
+            "Type": "container",
+            "Action": action,
+            "time": int(time()),
+            "Actor": {"ID": container.id, "Attributes": {"name": container.name, **container.labels, **attributes}},
+        }
+        for subscriber in list(self.subscribers):
+            subscriber.put(event)
+
+    def events(self, decode: bool = True, since=None, filters=None, **kwargs) -> Iterator[Dict]:
+        subscriber: queue.Queue = queue.Queue()
+        self.subscribers.append(subscriber)
+        label_key, equals, label_value = ((filters or {}).get("label", None) or "").partition("=")
+        actions = (filters or {}).get("event", None)
+
+        def stream():
+            while True:
+                event = subscriber.get()
+                if actions is not None and event["Action"] not in actions:
+                    continue
+                attributes = event["Actor"]["Attributes"]
+                if label_key and (label_key not in attributes or equals and attributes[label_key] != label_value):
+                    continue
+                yield event
+        return stream()
+
+    def info(self) -> Dict[str, Any]:
+        return {"MemTotal": FAKE_MEM_TOTAL, "NCPU": FAKE_CPUS, "ContainersRunning": len(self.containers.list())}
+
+    def ping(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        ...
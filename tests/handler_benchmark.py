@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import asyncio
+import json
+import logging
+from pathlib import Path
+from sys import exit
+from time import monotonic, perf_counter_ns
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import docker
+
+from tests.fake_docker import FakeDockerClient
+
+CODE = b'print("Hello, World!")\n'
+# Name, method, path, query string and body of every request the benchmark knows, {token} is a finished run.
+CASES: List[Tuple[str, str, str, bytes, bytes]] = [
+    ("healthz", "GET", "/healthz", b"", b""),
+    ("poll", "GET", "/poll/{token}", b"", b""),
+    ("poll_since", "GET", "/poll/{token}", b"since=14", b""),
+    ("poll_unknown", "GET", "/poll/unknown", b"", b""),
+    ("run_invalid", "POST", "/run/python", b"", b'{"exec": "not base64!"}'),
+    ("run", "POST", "/run/python", b"", json.dumps({"exec": "cHJpbnQoIkhlbGxvLCBXb3JsZCEiKQo="}).encode()),
+]
+
+
+def _load_server(client: FakeDockerClient):
+    # ingest_server builds its pipeline on import, so the fake daemon has to be in place before that.
+    docker.from_env = lambda **kwargs: client
+    from code_ingest import ingest_server
+    ingest_server.code_pipeline.req_dir = Path(__file__).parent.parent / "setup-code"
+    return ingest_server
+
+
+async def _call(app: Callable, method: str, path: str, query: bytes, body: bytes) -> Tuple[int, bytes]:
+
+    # Straight into the ASGI app, so the time is routing, parsing, the handler and encoding, with no HTTP or sockets.
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query,
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent: List[Dict[str, Any]] = []
+
+    async def receive() -> Dict[str, Any]:
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message: Dict[str, Any]) -> None:
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def _percentile(samples: List[int], percent: float) -> int:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)] if ordered else 0
+
+
+async def run_benchmark(args) -> Dict[str, Dict[str, float]]:
+    server = _load_server(FakeDockerClient())
+    await server.check_image()
+    started = monotonic()
+    while not server.code_pipeline.ready():
+        if monotonic() - started > 30:
+            raise RuntimeError("The server didn't become ready.")
+        await asyncio.sleep(0.01)
+
+    # One finished run for the poll cases to read.
+    status, body = await _call(server.app, *CASES[-1][1:])
+    token = json.loads(body)["token"]
+    await server.code_pipeline.poll_result(token, wait=10)
+
+    report = {}
+    for name, method, path, query, body in CASES:
+        if args.cases and name not in args.cases:
+            continue
+        path = path.format(token=token)
+        for _ in range(min(args.warmup, args.requests)):
+            await _call(server.app, method, path, query, body)
+
+        samples = []
+        for _ in range(args.requests):
+            begin = perf_counter_ns()
+            await _call(server.app, method, path, query, body)
+            samples.append(perf_counter_ns() - begin)
+
+        total = sum(samples)
+        report[name] = {
+            "mean_us": round(total / len(samples) / 1000, 1),
+            "p50_us": round(_percentile(samples, 50) / 1000, 1),
+            "p99_us": round(_percentile(samples, 99) / 1000, 1),
+            "per_second": round(len(samples) / (total / 1e9), 1) if total else 0.0,
+        }
+    return report
+
+
+def _arguments(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Time the HTTP request layer of the ingest server per request, calling the ASGI app directly "
+                    "against an in-process fake Docker daemon."
+    )
+    parser.add_argument("-n", "--requests", type=int, default=2000, help="Requests per case (default 2000)")
+    parser.add_argument("--warmup", type=int, default=200, help="Untimed requests before each case (default 200)")
+    parser.add_argument("-c", "--cases", nargs="*", choices=[case[0] for case in CASES],
+                        help="Only run these cases (default all)")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--max-mean-us", type=float, default=None,
+                        help="Exit with status 1 if any case's mean goes over this many microseconds")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    args = _arguments(argv)
+    report = asyncio.run(run_benchmark(args))
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for name, stats in report.items():
+            print(f"{name:>14}: " + ", ".join(f"{key} {value}" for key, value in stats.items()))
+
+    if args.max_mean_us is not None and any(stats["mean_us"] > args.max_mean_us for stats in report.values()):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
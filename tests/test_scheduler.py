@@ -0,0 +1,126 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List
+
+import pytest
+
+from code_ingest.scheduler import AdmissionQueue, QueueFullError
+
+
+class Recorder():
+
+    # Collects the order tokens are started in.
+
+    def __init__(self):
+        self.started: List[str] = []
+
+    def submit(self, queue, token, tenant="", priority="normal"):
+        queue.submit(token, lambda: self.started.append(token), tenant, priority)
+
+
+def test_runs_start_immediately_under_the_cap():
+    queue, runs = AdmissionQueue(2, 10), Recorder()
+    runs.submit(queue, "a")
+    runs.submit(queue, "b")
+    runs.submit(queue, "c")
+    assert runs.started == ["a", "b"]
+    assert queue.position("c") == 1
+    assert queue.position("a") is None
+
+
+def test_checker_runs_go_first():
+    queue, runs = AdmissionQueue(1, 10), Recorder()
+    runs.submit(queue, "running")
+    runs.submit(queue, "normal-1")
+    runs.submit(queue, "normal-2")
+    runs.submit(queue, "checker", priority="checker")
+    assert queue.position("checker") == 1
+    assert queue.position("normal-1") == 2
+
+    for token in ("running", "checker", "normal-1"):
+        queue.release(token)
+    assert runs.started == ["running", "checker", "normal-1", "normal-2"]
+
+
+def test_tenants_interleave_by_weight():
+    queue, runs = AdmissionQueue(1, 100, tenant_weights={"heavy": 2.0}), Recorder()
+    runs.submit(queue, "running")
+    for i in range(6):
+        runs.submit(queue, f"heavy-{i}", "heavy")
+    for i in range(3):
+        runs.submit(queue, f"light-{i}", "light")
+
+    for token in runs.started:
+        queue.release(token)
+    tenants = [token.split("-")[0] for token in runs.started[1:]]
+    assert tenants == ["heavy", "heavy", "light", "heavy", "heavy", "light", "heavy", "heavy", "light"]
+
+
+def test_tenant_running_cap_lets_other_tenants_past():
+    queue, runs = AdmissionQueue(10, 10, tenant_max_running=1), Recorder()
+    runs.submit(queue, "a-1", "a")
+    runs.submit(queue, "a-2", "a")
+    runs.submit(queue, "b-1", "b")
+    assert runs.started == ["a-1", "b-1"]
+    assert queue.stats()["a"] == {"running": "1", "queued": "1", "checker_queued": "0", "weight": "1.0"}
+
+    queue.release("a-1")
+    assert runs.started == ["a-1", "b-1", "a-2"]
+
+
+def test_tenant_queue_cap():
+    queue, runs = AdmissionQueue(1, 10, tenant_max_queued=2), Recorder()
+    runs.submit(queue, "running")
+    runs.submit(queue, "a-1", "a")
+    runs.submit(queue, "a-2", "a")
+    with pytest.raises(QueueFullError):
+        runs.submit(queue, "a-3", "a")
+    runs.submit(queue, "b-1", "b")
+
+
+def test_global_queue_cap():
+    queue, runs = AdmissionQueue(1, 1), Recorder()
+    runs.submit(queue, "running")
+    runs.submit(queue, "queued")
+    with pytest.raises(QueueFullError):
+        runs.submit(queue, "refused")
+
+
+def test_releasing_a_queued_run_drops_it():
+    queue, runs = AdmissionQueue(1, 10), Recorder()
+    runs.submit(queue, "running")
+    runs.submit(queue, "a", "a")
+    runs.submit(queue, "b", "b")
+    assert queue.release("a")
+    assert queue.position("a") is None
+    assert queue.position("b") == 1
+    assert "a" not in queue.stats()
+
+    queue.release("running")
+    assert runs.started == ["running", "b"]
+    assert not queue.release("a")
+    assert not queue.release("unknown")
+
+
+def test_clear_forgets_everything():
+    queue, runs = AdmissionQueue(1, 10), Recorder()
+    runs.submit(queue, "running")
+    runs.submit(queue, "queued")
+    queue.clear()
+    assert queue.position("queued") is None
+    assert queue.stats() == {}
+    runs.submit(queue, "fresh")
+    assert runs.started == ["running", "fresh"]
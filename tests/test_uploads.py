@@ -0,0 +1,152 @@
+# RACTF Code Ingest Server
+# Copyright (C) 2019-2020  RACTF Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import gzip
+import tarfile
+from io import BytesIO
+
+import pytest
+
+from code_ingest.uploads import SANDBOX_UID, UploadTooLargeError, sanitize_upload, spool_upload
+
+
+def _tar(*members, compress=False) -> BytesIO:
+    buffer = BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz" if compress else "w") as tar:
+        for info, data in members:
+            tar.addfile(info, BytesIO(data) if data is not None else None)
+    buffer.seek(0)
+    return buffer
+
+
+def _file(name, data=b"print(1)\n", mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.uid = info.gid = 0
+    return info, data
+
+
+def _special(name, kind, target=""):
+    info = tarfile.TarInfo(name)
+    info.type = kind
+    info.linkname = target
+    return info, None
+
+
+def _members(upload):
+    with upload, tarfile.open(fileobj=upload) as tar:
+        return {member.name: (member, tar.extractfile(member).read() if member.isfile() else None) for member in tar}
+
+
+async def _chunks(data, size=4096):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def _spool(data, compressed, max_size):
+    return asyncio.run(spool_upload(_chunks(data), compressed, max_size))
+
+
+def test_files_are_owned_by_the_sandbox_user():
+    members = _members(sanitize_upload(_tar(_file("main.py"), _file("src/lib.py", b"x = 1\n"))))
+    assert sorted(members) == ["main.py", "src/lib.py"]
+    member, data = members["src/lib.py"]
+    assert data == b"x = 1\n"
+    assert (member.uid, member.gid, member.uname, member.gname) == (SANDBOX_UID, SANDBOX_UID, "ractf", "ractf")
+
+
+def test_gzipped_uploads_are_read():
+    assert list(_members(sanitize_upload(_tar(_file("main.py"), compress=True)))) == ["main.py"]
+
+
+@pytest.mark.parametrize("mode, expected", [
+    (0o4755, 0o755),
+    (0o2755, 0o755),
+    (0o6777, 0o755),
+    (0o4644, 0o644),
+    (0o600, 0o644),
+    (0o100, 0o755),
+])
+def test_modes_are_normalised(mode, expected):
+    member, data = _members(sanitize_upload(_tar(_file("run", mode=mode))))["run"]
+    assert member.mode == expected
+
+
+@pytest.mark.parametrize("name", [
+    ".run.sh",
+    ".ready",
+    ".batch.py",
+    "setup.sh",
+    "./setup.sh",
+    "..",
+    "../escape.py",
+    "src/../../escape.py",
+    "/etc/passwd",
+    ".",
+])
+def test_reserved_and_escaping_names_are_refused(name):
+    with pytest.raises(ValueError):
+        sanitize_upload(_tar(_file(name)))
+
+
+def test_nested_dotfiles_are_kept():
+    assert "src/.config" in _members(sanitize_upload(_tar(_file("src/.config"))))
+
+
+@pytest.mark.parametrize("kind, target", [
+    (tarfile.SYMTYPE, "/etc/passwd"),
+    (tarfile.LNKTYPE, "main.py"),
+    (tarfile.CHRTYPE, ""),
+    (tarfile.BLKTYPE, ""),
+    (tarfile.FIFOTYPE, ""),
+])
+def test_links_and_devices_are_refused(kind, target):
+    with pytest.raises(ValueError):
+        sanitize_upload(_tar(_file("main.py"), _special("link", kind, target)))
+
+
+def test_garbage_is_refused():
+    with pytest.raises(ValueError):
+        sanitize_upload(BytesIO(b"not a tar file at all" * 100))
+
+
+def test_spool_keeps_the_upload():
+    data = _tar(_file("main.py"), compress=True).getvalue()
+    with _spool(data, True, 1 << 20) as upload:
+        assert upload.read() == data
+
+
+def test_spool_refuses_a_gzip_bomb():
+    bomb = gzip.compress(b"\0" * (8 << 20))
+    assert len(bomb) < 1 << 20
+    with pytest.raises(UploadTooLargeError):
+        _spool(bomb, True, 1 << 20)
+
+
+def test_spool_refuses_a_large_upload():
+    with pytest.raises(UploadTooLargeError):
+        _spool(b"\0" * ((1 << 20) + 1), False, 1 << 20)
+
+
+@pytest.mark.parametrize("data, compressed", [
+    (b"", False),
+    (gzip.compress(b"\0" * 4096)[:-12], True),
+    (b"not gzip", True),
+])
+def test_spool_refuses_empty_and_broken_uploads(data, compressed):
+    with pytest.raises(ValueError):
+        _spool(data, compressed, 1 << 20)